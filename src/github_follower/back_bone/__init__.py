@@ -1,4 +1,10 @@
 __name__ = "Back Bone"
 __version__ = "1.0.0"
 
-from .parser import *
\ No newline at end of file
+from .parser import *
+from .follow_index import *
+from .clock import *
+from .db import *
+from .jobs import *
+from .lease import *
+from .shards import *
\ No newline at end of file
@@ -0,0 +1,126 @@
+import asyncio
+import datetime
+import selectors
+import time
+
+class Clock():
+    # Wall clock time and real sleeps.
+    def time(self):
+        return time.time()
+
+    def now(self):
+        return datetime.datetime.fromtimestamp(self.time(), tz = datetime.timezone.utc)
+
+    async def sleep(self, secs):
+        await asyncio.sleep(secs)
+
+class Virtual_Clock(Clock):
+    # Simulated time. Coroutines ran through run() sleep on it and it's fast-forwarded to the next timer once every task is waiting on one.
+    def __init__(self, start = None, max_busy = 5.0):
+        self.start = time.time() if start is None else start
+
+        # Virtual seconds since start. The event loop's timers use these since epoch timestamps are too coarse for its clock resolution.
+        self.elapsed = 0.0
+
+        # Real seconds after which we fast-forward even though work outside the event loop hasn't finished (e.g. a request that's never answered).
+        self.max_busy = max_busy
+
+    @property
+    def cur(self):
+        return self.start + self.elapsed
+
+    @cur.setter
+    def cur(self, val):
+        self.elapsed = val - self.start
+
+    def time(self):
+        return self.cur
+
+    def advance(self, secs):
+        self.elapsed = self.elapsed + max(secs, 0.0)
+
+    def run(self, main, busy = None):
+        # Like asyncio.run() on a Virtual_Event_Loop. busy() returns True while other work outside the event loop (e.g. requests) runs.
+        loop = Virtual_Event_Loop(self, busy)
+
+        try:
+            asyncio.set_event_loop(loop)
+
+            return loop.run_until_complete(main)
+        finally:
+            try:
+                tasks = asyncio.all_tasks(loop)
+
+                for task in tasks:
+                    task.cancel()
+
+                loop.run_until_complete(asyncio.gather(*tasks, return_exceptions = True))
+                loop.run_until_complete(loop.shutdown_asyncgens())
+            finally:
+                asyncio.set_event_loop(None)
+
+                loop.close()
+
+class Virtual_Selector(selectors.DefaultSelector):
+    def __init__(self, loop):
+        super().__init__()
+
+        self.loop = loop
+
+    def select(self, timeout = None):
+        # The event loop only blocks (timeout isn't 0) once no callbacks are ready.
+        if timeout is not None and timeout <= 0:
+            return super().select(timeout)
+
+        events = super().select(0)
+
+        if len(events) > 0:
+            return events
+
+        # Wait for outside work. Executor calls and responses wake us up through the loop's self-pipe and sockets.
+        start = time.monotonic()
+
+        while self.loop.is_busy():
+            left = self.loop.clock.max_busy - (time.monotonic() - start)
+
+            if left <= 0:
+                break
+
+            events = super().select(left)
+
+            if len(events) > 0:
+                return events
+
+        # Only tasks waiting on timers are left (or none if timeout is None) so jump to the next one.
+        if timeout is None:
+            return super().select(None)
+
+        self.loop.clock.advance(timeout)
+
+        return []
+
+class Virtual_Event_Loop(asyncio.SelectorEventLoop):
+    # Event loop whose timers (asyncio.sleep(), call_later(), timeouts) run on a Virtual_Clock.
+    def __init__(self, clock, busy = None):
+        self.clock = clock
+        self.busy = busy
+
+        # Executor calls (e.g. database calls through sync_to_async) that haven't finished yet.
+        self.running = set()
+
+        super().__init__(Virtual_Selector(self))
+
+    def time(self):
+        return self.clock.elapsed
+
+    def run_in_executor(self, executor, func, *args):
+        fut = super().run_in_executor(executor, func, *args)
+
+        self.running.add(fut)
+
+        fut.add_done_callback(self.running.discard)
+
+        return fut
+
+    def is_busy(self):
+        return len(self.running) > 0 or (self.busy is not None and self.busy())
@@ -0,0 +1,124 @@
+import time
+
+from django.db import transaction
+
+from asgiref.sync import sync_to_async
+
+import misc
+
+class DB_Batch():
+    # Database writes queued by the crawl loops and ran together in one executor hop and transaction instead of one hop per item.
+    def __init__(self):
+        # Following rows to insert.
+        self.following = []
+
+        # User IDs to mark as purged keyed by target user ID.
+        self.purged = {}
+
+        # Jobs to enqueue.
+        self.jobs = []
+
+        # Objects with fields to update keyed by model and primary key as [object, fields].
+        self.updates = {}
+
+        # Other work as (function, args, kwargs). Functions run in the database thread.
+        self.ops = []
+
+        # When the oldest queued item was added.
+        self.since = None
+
+    def __len__(self):
+        return len(self.following) + sum(len(ids) for ids in self.purged.values()) + len(self.jobs) + sum(len(items) for items in self.updates.values()) + len(self.ops)
+
+    def queued(self):
+        if self.since is None:
+            self.since = time.monotonic()
+
+    def is_due(self, max_age):
+        # Whether the oldest queued item has waited longer than max_age seconds.
+        return self.since is not None and time.monotonic() - self.since >= max_age
+
+    def add_following(self, following):
+        self.following.append(following)
+
+        self.queued()
+
+    def set_purged(self, tuser, user):
+        self.purged.setdefault(tuser.pk, set()).add(user.pk)
+
+        self.queued()
+
+    def add_job(self, job):
+        self.jobs.append(job)
+
+        self.queued()
+
+    def update(self, obj, fields):
+        # Write-behind for obj.save(update_fields = fields). Fields of the same object are merged and the latest values are written.
+        items = self.updates.setdefault(type(obj), {})
+
+        item = items.get(obj.pk)
+
+        if item is None:
+            items[obj.pk] = [obj, set(fields)]
+        else:
+            item[0] = obj
+            item[1].update(fields)
+
+        self.queued()
+
+    def add(self, func, *args, **kwargs):
+        self.ops.append((func, args, kwargs))
+
+        self.queued()
+
+    @misc.traced("db_batch")
+    @sync_to_async
+    @misc.traced("db")
+    def write(self, following, purged, jobs, updates, ops):
+        import gf.models as mdl
+
+        with transaction.atomic():
+            # Inserts go first so rows followed and purged within the same batch end up purged.
+            if len(following) > 0:
+                mdl.Following.objects.bulk_create(following, ignore_conflicts = True)
+
+            for tuser_id, user_ids in purged.items():
+                mdl.Following.objects.filter(target_user_id = tuser_id, user_id__in = list(user_ids)).update(purged = True)
+
+            # Jobs for work that's already pending are skipped by the pending job constraints.
+            if len(jobs) > 0:
+                mdl.Job.objects.bulk_create(jobs, ignore_conflicts = True)
+
+            # One bulk update for each model and set of fields.
+            for model, items in updates.items():
+                groups = {}
+
+                for obj, fields in items.values():
+                    groups.setdefault(tuple(sorted(fields)), []).append(obj)
+
+                for fields, objs in groups.items():
+                    model.objects.bulk_update(objs, fields)
+
+            for func, args, kwargs in ops:
+                func(*args, **kwargs)
+
+    async def flush(self):
+        if len(self) < 1:
+            return
+
+        # Swap the queues out first so items added while we're writing go to the next flush.
+        following, purged, jobs, updates, ops = self.following, self.purged, self.jobs, self.updates, self.ops
+
+        self.following = []
+        self.purged = {}
+        self.jobs = []
+        self.updates = {}
+        self.ops = []
+        self.since = None
+
+        try:
+            await self.write(following, purged, jobs, updates, ops)
+        except Exception as e:
+            print("[ERR] Failed to write DB batch.")
+            print(e)
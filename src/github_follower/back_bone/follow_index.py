@@ -0,0 +1,19 @@
+class Follow_Index():
+    def __init__(self, following = (), followers = ()):
+        # User IDs the target user has followed and that follow the target user.
+        self.following = set(following)
+        self.followers = set(followers)
+
+    def add_following(self, user_id):
+        self.following.add(user_id)
+
+    def add_followers(self, user_ids):
+        self.followers.update(user_ids)
+
+    def merge(self, other):
+        self.following.update(other.following)
+        self.followers.update(other.followers)
+
+    def should_follow(self, user_id):
+        # Don't follow users we've followed before or who already follow us.
+        return user_id not in self.following and user_id not in self.followers
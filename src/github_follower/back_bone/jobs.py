@@ -0,0 +1,120 @@
+import datetime
+import os
+import socket
+
+from django.db import transaction
+from django.db.models import Q, F, Count
+
+from asgiref.sync import sync_to_async
+
+import misc
+
+# Times a job is tried before it's marked as failed.
+MAX_ATTEMPTS = 5
+
+# Seconds a failed job waits before it's retried, multiplied by its attempt count.
+RETRY_TIME = 60
+
+# Seconds finished jobs are kept for.
+KEEP_TIME = 86400
+
+def get_owner():
+    return socket.gethostname() + ":" + str(os.getpid())
+
+class Job_Queue():
+    def __init__(self, owner = None):
+        # Name stored on the jobs we claim.
+        self.owner = get_owner() if owner is None else owner
+
+    def get_claimable(self, kinds, now):
+        import gf.models as mdl
+
+        # Queued jobs past their retry backoff and running jobs whose lease expired (e.g. their worker died).
+        return mdl.Job.objects.filter(kind__in = kinds).filter(Q(status = "queued", lease_until__isnull = True) | Q(status = "queued", lease_until__lte = now) | Q(status = "running", lease_until__lt = now))
+
+    @sync_to_async
+    def enqueue(self, jobs):
+        import gf.models as mdl
+
+        # Jobs for work that's already pending are skipped by the pending job constraints.
+        mdl.Job.objects.bulk_create(jobs, ignore_conflicts = True)
+
+    @misc.traced("claim_jobs")
+    @sync_to_async
+    @misc.traced("db")
+    def claim(self, kinds, max_jobs, now, lease, shard = None):
+        import gf.models as mdl
+
+        until = now + datetime.timedelta(seconds = lease)
+
+        qs = self.get_claimable(kinds, now)
+
+        # Only claim jobs of users in our shard.
+        if shard is not None:
+            qs = shard.filter(qs, "user_id")
+
+        with transaction.atomic():
+            ids = list(qs.select_for_update(skip_locked = True).order_by("id").values_list("id", flat = True)[:max_jobs])
+
+            if len(ids) < 1:
+                return []
+
+            # Only take jobs that are still claimable. SQLite has no row locks so another process may have read the same IDs.
+            self.get_claimable(kinds, now).filter(id__in = ids).update(status = "running", lease_until = until, owner = self.owner, attempts = F("attempts") + 1)
+
+        # Retrieve the jobs we got.
+        return list(mdl.Job.objects.filter(id__in = ids, status = "running", owner = self.owner, lease_until = until).select_related("target_user__user", "user").order_by("id"))
+
+    def finish(self, done, failed, now):
+        import gf.models as mdl
+
+        # Ran in the database thread (e.g. through DB_Batch).
+        if len(done) > 0:
+            mdl.Job.objects.filter(id__in = [job.id for job in done], owner = self.owner).update(status = "done", lease_until = None)
+
+        for job in failed:
+            # Give up after too many attempts or retry with a backoff.
+            if job.attempts >= MAX_ATTEMPTS:
+                mdl.Job.objects.filter(id = job.id, owner = self.owner).update(status = "failed", lease_until = None)
+            else:
+                mdl.Job.objects.filter(id = job.id, owner = self.owner).update(status = "queued", lease_until = now + datetime.timedelta(seconds = RETRY_TIME * job.attempts))
+
+    @sync_to_async
+    def renew(self, jobs, now, lease):
+        import gf.models as mdl
+
+        # Extend the lease of jobs we're still working on (e.g. while waiting out a rate limit reset). Leases are never shortened.
+        until = now + datetime.timedelta(seconds = lease)
+
+        if len(jobs) > 0:
+            mdl.Job.objects.filter(id__in = [job.id for job in jobs], owner = self.owner, status = "running", lease_until__lt = until).update(lease_until = until)
+
+    def release(self, jobs):
+        import gf.models as mdl
+
+        # Put claimed jobs we didn't get to back into the queue without counting the attempt.
+        if len(jobs) > 0:
+            mdl.Job.objects.filter(id__in = [job.id for job in jobs], owner = self.owner, status = "running").update(status = "queued", lease_until = None, attempts = F("attempts") - 1)
+
+    @sync_to_async
+    def count_pending(self, kind, shard = None):
+        import gf.models as mdl
+
+        qs = mdl.Job.objects.filter(kind = kind, status__in = ["queued", "running"])
+
+        if shard is not None:
+            qs = shard.filter(qs, "user_id")
+
+        return qs.count()
+
+    @sync_to_async
+    def prune(self, now):
+        import gf.models as mdl
+
+        mdl.Job.objects.filter(status__in = ["done", "failed"], time_added__lt = now - datetime.timedelta(seconds = KEEP_TIME)).delete()
+
+    def get_counts(self):
+        import gf.models as mdl
+
+        # Job count by kind and status in one query.
+        return {(row["kind"], row["status"]): row["cnt"] for row in mdl.Job.objects.values("kind", "status").annotate(cnt = Count("id"))}
@@ -0,0 +1,51 @@
+import datetime
+
+from django.db import transaction, IntegrityError
+from django.db.models import Q
+from django.db.models.functions import Now
+
+from asgiref.sync import sync_to_async
+
+from .jobs import get_owner
+
+# Seconds a lease is held for without being renewed.
+LEASE_TIME = 30
+
+class Leader_Lease():
+    def __init__(self, name = "parser", owner = None, ttl = LEASE_TIME):
+        self.name = name
+        self.owner = get_owner() if owner is None else owner
+        self.ttl = ttl
+
+    @sync_to_async
+    def acquire(self, now = None):
+        import gf.models as mdl
+
+        # Without a time (outside of simulations) the DB's clock is used so hosts with skewed clocks agree on when leases expire.
+        if now is None:
+            now = Now()
+
+        # Returns True if we hold the lease until now + ttl.
+        until = now + datetime.timedelta(seconds = self.ttl)
+
+        # Renew our lease or take over one that expired or was released in one conditional update.
+        cnt = mdl.Lease.objects.filter(name = self.name).filter(Q(owner = self.owner) | Q(lease_until__isnull = True) | Q(lease_until__lt = now)).update(owner = self.owner, lease_until = until)
+
+        if cnt > 0:
+            return True
+
+        # Create the lease if it doesn't exist yet. Somebody else holds it if this fails.
+        try:
+            with transaction.atomic():
+                mdl.Lease.objects.create(name = self.name, owner = self.owner, lease_until = until)
+        except IntegrityError:
+            return False
+
+        return True
+
+    @sync_to_async
+    def release(self):
+        import gf.models as mdl
+
+        # Let another process take over right away.
+        mdl.Lease.objects.filter(name = self.name, owner = self.owner).update(lease_until = None)
@@ -1,29 +1,56 @@
 import github_api as ga
+import github_api.graphql as gql
+import misc
+from .follow_index import Follow_Index
+from .clock import Clock
+from .db import DB_Batch
+from .jobs import Job_Queue
+from .shards import Shard
 import json
 import asyncio
 
-import threading
 import datetime
-from django.conf import settings
-from django.utils.timezone import make_aware
-from django.db.models import F
+from django.db.models import F, Q, Count, Exists, OuterRef, Value
+from django.db import transaction
 
 import random
 
 from asgiref.sync import sync_to_async
 
-class Parser(threading.Thread):
-    def __init__(self):
-        # Initialize thread.
-        super().__init__()
+# Max seconds the purge loop sleeps before checking target users again.
+PURGE_MAX_WAIT = 300
 
-        # Set daemon to true.
-        self.daemon = True
+# Seconds between checks of the enabled setting and the parser's tasks.
+LOOP_TIME = 5
+
+# Seconds between follower sync worker checks.
+SYNC_SUPERVISE_TIME = 5
+
+# Max seconds parse_users keeps writes of a batch queued before flushing them.
+BATCH_FLUSH_TIME = 30
+
+# Seconds a job worker waits before checking an empty queue again. Workers are woken right away when this process queues jobs.
+JOB_POLL_TIME = 5
+
+# Seconds cached responses are kept for after they were last updated. Pages answered with 304 keep their time so they're fetched in full about once per period.
+CACHE_KEEP_TIME = 86400
+
+# Seconds before users we've seeded from are seeded from again to check their last page for new followers.
+RESEED_TIME = 86400
+
+# Seconds a claimed job may run for before its lease expires and other workers may claim it. The follow waits of the claimed jobs are added.
+JOB_LEASE_TIME = 300
+
+class Parser():
+    def __init__(self, clock = None):
+        # Clock used for all waits and timestamps so it may be replaced by a virtual clock in simulations.
+        self.clock = Clock() if clock is None else clock
 
         self.running = False
         self.locked = False
 
-        self.api = None
+        # GitHub API clients keyed by target user or global credential.
+        self.clients = ga.Client_Registry(self.clock)
 
         self.global_token = None
         self.global_username = None
@@ -32,42 +59,228 @@ class Parser(threading.Thread):
         self.retrieve_followers_task = None
         self.purge_following_task = None
 
-        self.retrieve_and_save_task = None
+        # Job workers.
+        self.follow_jobs_task = None
+        self.seed_jobs_task = None
 
-    def run(self):
-        print("Parser is running...")
+        # Durable follow, unfollow and seeding queue.
+        self.jobs = Job_Queue()
 
-        self.running = True
+        # Events of idle job workers that are set when this process queues jobs.
+        self.job_waiters = set()
+
+        # Users (and their jobs) this process parses. Other worker processes parse the other shards.
+        self.shard = Shard()
+
+        # Whether this process runs the target user loops (follower sync and purging). Only one worker process does.
+        self.leader = True
+
+        misc.parser_shard.set(self.shard.index)
+        misc.parser_shards.set(self.shard.count)
+        misc.parser_leader.set(1)
+
+        # DB query count of each loop's last cycle.
+        self.cycle_queries = {}
+
+        # Restart count of each supervised task.
+        self.restarts = {}
+
+        # GitHub relationships of the users being parsed keyed by target user ID and username (GraphQL only).
+        self.relations = {}
+
+        # Follow-state index of each target user.
+        self.indexes = {}
+
+        # Target user IDs whose index should be reloaded from the database.
+        self.stale_indexes = set()
 
-        # Start the back-end parser.
-        asyncio.run(self.work())
+        # Follower sync state.
+        self.sync_slots = None
+        self.target_users = {}
+        self.sync_pages = {}
 
+    @misc.traced("claim_users")
     @sync_to_async
-    def get_users(self, gnames, need_parse = True):
+    @misc.traced("db")
+    def claim_users(self, max_users):
         import gf.models as mdl
 
-        res = mdl.User.objects.all().exclude(username__in = gnames).order_by('needs_to_seed', F('last_parsed').asc(nulls_first = True))
+        with transaction.atomic():
+            # Retrieve the next batch of users to parse excluding target users. The limit is applied by the database using the parse queue index (needs_parsing is matched with IN so SQLite compares it as an index column instead of a bare boolean).
+            users = list(self.shard.filter(mdl.User.objects.select_for_update(skip_locked = True, of = ("self",)).filter(needs_parsing__in = [True], target_user__isnull = True)).order_by('needs_to_seed', F('last_parsed').asc(nulls_first = True))[:max_users])
 
-        if need_parse:
-            res.filter(needs_parsing = True)
+            now = self.clock.now()
 
-        return list(res)
+            # Stamp last parsed for the whole batch in one update.
+            mdl.User.objects.filter(id__in = [user.id for user in users]).update(last_parsed = now)
 
+        for user in users:
+            user.last_parsed = now
+
+        return users
+
+    @misc.traced("get_target_users")
     @sync_to_async
+    @misc.traced("db")
     def get_target_users(self):
         import gf.models as mdl
 
         return list(mdl.Target_User.objects.all().select_related('user'))
 
+    def update_queue_metrics(self):
+        import gf.models as mdl
+
+        # Users waiting in the parse queue in one query.
+        queue = mdl.User.objects.filter(needs_parsing__in = [True], target_user__isnull = True).aggregate(total = Count("id"), never_parsed = Count("id", filter = Q(last_parsed__isnull = True)))
+
+        misc.parse_queue.set(queue["total"], state = "total")
+        misc.parse_queue.set(queue["never_parsed"], state = "never_parsed")
+
+        # Jobs by kind and status including the ones there are none of.
+        counts = self.jobs.get_counts()
+
+        for kind, _ in mdl.Job.KINDS:
+            for status, _ in mdl.Job.STATUSES:
+                misc.job_queue.set(counts.get((kind, status), 0), kind = kind, status = status)
+
+    @sync_to_async
+    def count_free_users(self):
+        import gf.models as mdl
+
+        # Count non-target users without any following entry in one anti-join query.
+        following = mdl.Following.objects.filter(user = OuterRef("pk"))
+
+        return mdl.User.objects.filter(target_user__isnull = True).exclude(Exists(following)).count()
+
+    @sync_to_async
+    def load_index(self, tuser):
+        import gf.models as mdl
+
+        following = mdl.Following.objects.filter(target_user = tuser).values_list("user_id", flat = True)
+        followers = mdl.Follower.objects.filter(target_user = tuser).values_list("user_id", flat = True)
+
+        return Follow_Index(following, followers)
+
+    async def get_index(self, tuser):
+        # Load the target user's index once and keep it up to date afterwards.
+        if tuser.pk not in self.indexes:
+            self.indexes[tuser.pk] = await self.load_index(tuser)
+        elif tuser.pk in self.stale_indexes:
+            self.stale_indexes.discard(tuser.pk)
+
+            # Merge so follows of ours that aren't written yet are kept.
+            self.indexes[tuser.pk].merge(await self.load_index(tuser))
+
+        return self.indexes[tuser.pk]
+
+    def note_following(self, tuser, user):
+        if tuser.pk in self.indexes:
+            self.indexes[tuser.pk].add_following(user.id)
+
+    def note_followers(self, tuser, user_ids):
+        if tuser.pk in self.indexes:
+            self.indexes[tuser.pk].add_followers(user_ids)
+
+    @sync_to_async
+    def get_followed(self, jobs):
+        import gf.models as mdl
+
+        # Retrieve (target user ID, user ID) of follow jobs whose user is followed already or follows the target user in one query. Maps them to True if followed and False if only following us.
+        jobs = [job for job in jobs if job.kind == "follow"]
+
+        if len(jobs) < 1:
+            return {}
+
+        tusers = set(job.target_user_id for job in jobs)
+        users = set(job.user_id for job in jobs)
+
+        following = mdl.Following.objects.filter(target_user_id__in = tusers, user_id__in = users).annotate(followed = Value(True)).values_list("target_user_id", "user_id", "followed")
+        followers = mdl.Follower.objects.filter(target_user_id__in = tusers, user_id__in = users).annotate(followed = Value(False)).values_list("target_user_id", "user_id", "followed")
+
+        followed = {}
+
+        for tuser_id, user_id, is_followed in following.union(followers, all = True):
+            followed[(tuser_id, user_id)] = followed.get((tuser_id, user_id), False) or bool(is_followed)
+
+        return followed
+
     @sync_to_async
-    def get_setting(self, key):
+    def get_expired_following(self, tuser, cutoff):
         import gf.models as mdl
 
-        val = mdl.Setting.get(key = key)
+        cutoff = datetime.datetime.fromtimestamp(cutoff, tz = datetime.timezone.utc)
+
+        # Purged is matched with IN so SQLite can use the purge index. Users waiting for their new username are left until they show up under it.
+        return list(mdl.Following.objects.filter(target_user = tuser, purged__in = [False], time_added__lte = cutoff).exclude(user__username__startswith = "#").select_related("user").order_by("time_added"))
+
+    @sync_to_async
+    def prune_cache(self, now):
+        import gf.models as mdl
 
-        return val
+        # Drop cached responses that weren't updated for a while (e.g. seed pages we moved past).
+        mdl.Response_Cache.objects.filter(time_updated__lt = now - datetime.timedelta(seconds = CACHE_KEEP_TIME)).delete()
 
     @sync_to_async
+    def get_first_following(self, tuser):
+        import gf.models as mdl
+
+        return mdl.Following.objects.filter(target_user = tuser, purged__in = [False]).exclude(user__username__startswith = "#").order_by("time_added").values_list("time_added", flat = True).first()
+
+    def set_shard(self, shard):
+        if shard == self.shard:
+            return
+
+        print("Parsing shard " + str(shard) + ".")
+
+        self.shard = shard
+
+        misc.parser_shard.set(shard.index)
+        misc.parser_shards.set(shard.count)
+
+        # Users moving into our shard may have been followed by other workers so reload the follow-state indexes.
+        self.stale_indexes = set(self.indexes.keys())
+
+    def set_leader(self, leader):
+        self.leader = leader
+
+        misc.parser_leader.set(int(leader))
+
+    def get_follow_wait(self):
+        # Every worker follows the users of its own shard so stretch the wait to keep each target user's overall follow rate.
+        return float(random.randint(self.conf.wait_time_follow_min, self.conf.wait_time_follow_max) * self.shard.count)
+
+    def set_clock(self, clock):
+        self.clock = clock
+
+        self.clients.set_clock(clock)
+
+    def add_restart(self, task):
+        self.restarts[task] = self.restarts.get(task, 0) + 1
+
+        misc.task_restarts.inc(task = task)
+
+    @property
+    def conf(self):
+        from gf.registry import registry
+
+        return registry.snapshot
+
+    def start_cycle(self, loop):
+        # Attribute this task's queries and spans to the loop.
+        misc.cur_loop.set(loop)
+        misc.tracer.set_root(loop)
+
+        return misc.counter.get_count(loop)
+
+    def end_cycle(self, loop, start):
+        self.cycle_queries[loop] = misc.counter.get_count(loop) - start
+
+        if self.conf.verbose >= 3:
+            print("[VVV] " + loop + " cycle ran " + str(self.cycle_queries[loop]) + " DB queries.")
+
+    @misc.traced("get_filtered")
+    @sync_to_async
+    @misc.traced("db")
     def get_filtered(self, otype, params = {}, related = [], sort = []):
         if len(params) < 1:
             return list(otype.objects.all().distinct())
@@ -82,34 +295,64 @@ class Parser(threading.Thread):
 
             return list(items)
 
+    @misc.traced("save_seeded_users")
+    @sync_to_async
+    @misc.traced("db")
+    def save_seeded_users(self, refs, parent):
+        import gf.models as mdl
 
-    async def do_fail(self):
-        if self.api is None:
-            return
+        # Match the page's users by GitHub ID and insert the new ones in one statement.
+        users, created = mdl.User.match(refs, parent = parent.id, auto_added = True)
 
-        # Increase fail count.
-        self.api.add_fail()
+        return [new_user.username for new_user in created]
 
-        try:
-            max_fails = int(await self.get_setting("max_api_fails"))
-        except Exception as e:
-            print("[ERR] parser.do_fail() :: Failed to receive max fails.")
-            print(e)
+    @misc.traced("save_followers")
+    @sync_to_async
+    @misc.traced("db")
+    def save_followers(self, tuser, refs):
+        import gf.models as mdl
 
-            return
+        # Match users by GitHub ID so renamed followers aren't added again and create the ones we don't know about yet.
+        users, created = mdl.User.match(refs, needs_parsing = False)
+
+        # Add users to the follower list if not already on it.
+        followers = set(mdl.Follower.objects.filter(target_user = tuser, user__in = users).values_list("user_id", flat = True))
+
+        new_followers = [mdl.Follower(target_user = tuser, user = muser) for muser in users if muser.id not in followers]
+
+        if len(new_followers) > 0:
+            mdl.Follower.objects.bulk_create(new_followers, ignore_conflicts = True)
+
+        # Return the users the target user is following back.
+        following = set(mdl.Following.objects.filter(target_user = tuser, user__in = users, purged = False).values_list("user_id", flat = True))
+
+        return [muser.id for muser in users], [muser for muser in users if muser.id in following]
+
+    def get_api(self, tuser = None):
+        # Use the global credential if no target user is given.
+        if tuser is None:
+            return self.clients.get("global", self.global_username, self.global_token)
+
+        return self.clients.get(tuser.pk, tuser.user.username, tuser.token)
+
+    async def do_fail(self, api):
+        # Increase fail count.
+        api.add_fail()
+
+        max_fails = self.conf.max_api_fails
 
         if max_fails < 1:
             return
 
-        if int(await self.get_setting("verbose")) >= 3:
-            print("[VVV] Adding fail (" + str(self.api.fails) + " > " + str(max_fails) + ").")
+        if self.conf.verbose >= 3:
+            print("[VVV] Adding fail (" + str(api.fails) + " > " + str(max_fails) + ").")
         
         #  If fail count exceeds max fails setting, set locked to True and stop everything.
-        if self.api.fails >= max_fails:
+        if api.fails >= max_fails:
             self.running = False
             self.locked = True
 
-            if int(await self.get_setting("verbose")) >= 1:
+            if self.conf.verbose >= 1:
                 print("[V] Bot stopped due to fail count exceeding. Waiting specified time frame until starting again.")
 
             # Run lockout task in background.
@@ -120,7 +363,53 @@ class Parser(threading.Thread):
 
         return
 
+    async def iter_followers(self, api, login = None, page = 1, after = None, last_page = 0, slots = None, cached_pages = None):
+        # Yields (users, page, next page, next cursor) with users as User_Refs using the configured transport. The cursor is only used by GraphQL. Leave login as None for the client's own followers.
+        if self.conf.api_transport == "graphql":
+            async for item in gql.iter_followers(api, login, page = page, after = after, last_page = last_page, slots = slots, on_limited = self.wait_rate_limit):
+                yield item
+
+            return
+
+        url = '/user/followers' if login is None else '/users/' + login + '/followers'
+
+        async for data, page, next_page in ga.iter_pages(api, url, page = page, last_page = last_page, slots = slots, on_limited = self.wait_rate_limit, decode = ga.decode_users, cached_pages = cached_pages):
+            yield data, page, next_page, None
+
+    async def lookup_relations(self, users, target_users):
+        self.relations = {}
+
+        logins = [user.username for user in users]
+
+        if len(logins) < 1:
+            return
+
+        for tuser in target_users:
+            api = self.get_api(tuser)
+
+            try:
+                self.relations[tuser.pk] = await gql.lookup_users(api, logins, on_limited = self.wait_rate_limit)
+            except (ga.Page_Error, json.JSONDecodeError) as e:
+                print("[ERR] Failed to look up relationships for " + tuser.user.username + ".")
+                print(e)
+
+    async def wait_rate_limit(self, api, res):
+        budget = api.get_budget(res[2].get("X-RateLimit-Resource", "core"))
+
+        if not budget.is_limited(res[1]):
+            return False
+
+        wait = budget.wait_time()
+
+        if self.conf.verbose >= 2:
+            print("[VV] Rate limited with " + str(budget.remaining) + " requests remaining. Waiting " + str(round(wait, 1)) + " seconds.")
+
+        await self.clock.sleep(wait)
+
+        return True
+
     async def retrieve_and_save_followers(self, user):
+        # Returns False if retrieving the followers failed.
         import gf.models as mdl
 
         # Ignore targeted users.
@@ -136,354 +425,523 @@ class Parser(threading.Thread):
             targeted = False
 
         if targeted:
-            return
+            return True
 
         # Make sure we don't have enough free users (users who aren't following anybody)..
-        free_users = int(await self.get_setting("seed_min_free"))
+        free_users = self.conf.seed_min_free
 
         if free_users > 0:
-            target_users = await self.get_target_users()
+            # If we have enough free users, 
+            if await self.count_free_users() > free_users:
+                return True
 
-            # Loop for target GitHub usernames to exclude from parsing list.
-            gnames = []
+        # Use the global client.
+        api = self.get_api()
 
-            for user in target_users:
-                gnames.append(user.user.username)
+        cursor = user.cur_page
+        after = user.cur_cursor
 
-            users = await self.get_users(gnames)
-            user_cnt = 0
+        ok = True
 
-            for user in users:
-                if len(await self.get_filtered(mdl.Following, {"user": user})) < 1:
-                    user_cnt = user_cnt + 1
+        # Go through the user's followers from where we left off. Only the page we resume from is requested again (e.g. the last page to check for new followers) so only it is cached.
+        try:
+            async for data, page, next_page, next_after in self.iter_followers(api, user.username, page = user.cur_page, after = user.cur_cursor or None, last_page = self.conf.seed_max_pages, cached_pages = lambda page: page == user.cur_page):
+                # Resume from the next page or check the last page again next time.
+                if next_page is not None:
+                    cursor = next_page
+                    after = next_after
+                else:
+                    cursor = page
+
+                # Save the whole page at once. Users without an ID or login were skipped when decoding.
+                added = await self.save_seeded_users(data, user)
+
+                misc.users_seeded.inc(len(added))
+
+                if self.conf.verbose >= 3:
+                    for login in added:
+                        print("[V] Adding user " + login + " (parent " + user.username + ")")
+
+                if next_page is not None:
+                    await self.clock.sleep(float(random.randint(self.conf.wait_time_list_min, self.conf.wait_time_list_max)))
+        except ga.Page_Error as e:
+            print("[ERR] Failed to retrieve user's following list for " + user.username + " (request failure).")
+            print(e)
 
-            # If we have enough free users, 
-            if user_cnt > free_users:
-                return
+            ok = False
 
-        page = user.cur_page
+            await self.do_fail(api)
+        except json.JSONDecodeError as e:
+            print("[ERR] Failed to retrieve user's following list for " + user.username + " (JSON decode failure).")
+            print(e)
 
-        # Create a loop and go through.
-        while True:
-            # Make new connection got GitHub API and set user agent.
-            if self.api is None:
-                self.api = ga.GH_API()
+            ok = False
 
-            # Authenticate globally.
-            if self.global_username is not None and self.global_token is not None:
-                self.api.authenticate(self.global_username, self.global_token)
+        # Save page and user. Users are only seeded from again once RESEED_TIME passed since they were seeded successfully.
+        fields = []
 
-            res = None
+        if cursor != user.cur_page or after != user.cur_cursor:
+            user.cur_page = cursor
+            user.cur_cursor = after or ""
 
-            # Try sending request to GitHub API.
-            try:
-                res = await self.api.send("GET", '/users/' + user.username + '/followers?page=' + str(page))
-            except Exception as e:
-                print("[ERR] Failed to retrieve user's following list for " + user.username + " (request failure).")
-                print(e)
+            fields.extend(["cur_page", "cur_cursor"])
 
-                await self.do_fail()
+        if ok:
+            user.last_seeded = self.clock.now()
 
-                break
+            fields.append("last_seeded")
 
-            # Check status code.
-            if res[1] != 200 and res[1] != 204:
-                await self.do_fail()
+        if len(fields) > 0:
+            with misc.span("save"):
+                await sync_to_async(user.save)(update_fields = fields)
 
-                break
+        return ok
 
-            # Decode JSON.
-            try:
-                data = json.loads(res[0])
-            except json.JSONDecodeError as e:
-                print("[ERR] Failed to retrieve user's following list for " + self.username + " (JSON decode failure).")
-                print(e)
+    def should_seed(self, user):
+        # Users whose followers we went through up to seed_max_pages have nothing left to seed.
+        if self.conf.seed_max_pages > 0 and user.cur_page > self.conf.seed_max_pages:
+            return False
 
-                break
+        return user.last_seeded is None or (self.clock.now() - user.last_seeded).total_seconds() >= RESEED_TIME
 
-            # Make sure we have data, if not, break the loop.
-            if len(data) < 1 or page >= int(await self.get_setting("seed_max_pages")):
-                # Save page and user.
-                user.cur_page = page
+    async def loop_and_follow_targets(self, user, target_users, batch = None):
+        import gf.models as mdl
+
+        # First, we should make sure we're following the target users.
+        for tuser in target_users:
+            index = await self.get_index(tuser)
 
-                await sync_to_async(user.save)()
+            # Check if we're following or being followed by the user already.
+            if not index.should_follow(user.id):
+                continue
 
-                break
+            # If GitHub told us the target user already follows this user, only record it.
+            state = self.relations.get(tuser.pk, {}).get(user.username)
 
-            for nuser in data:
-                if "id" not in nuser:
-                    print("[ERR] ID field not found in JSON data.")
+            if state is not None and state["viewerIsFollowing"]:
+                await tuser.add_following(user, batch)
 
-                    continue
+                continue
 
-                if "login" not in nuser:
-                    print("[ERR] ID field not found in JSON data.")
+            # Users following the target user already aren't followed. The follower sync saves them so only the index is told.
+            if state is not None and state["isFollowingViewer"]:
+                self.note_followers(tuser, [user.id])
 
-                    continue
+                continue
 
-                # Check if user exists already.
-                exists = True
+            # Queue following the user for the job workers.
+            await self.enqueue_job(mdl.Job(kind = "follow", target_user = tuser, user = user), batch)
 
-                try:
-                    new_user = await self.get_filtered(mdl.User, {"username": nuser["login"]})
-                    new_user = new_user[0]
-                except Exception as e:
-                    exists = False
+    async def parse_user(self, user, target_users, batch = None, seed = False):
+        import gf.models as mdl
 
-                if exists and new_user is None:
-                    exists = False
+        # Users that were renamed while claimed are parsed once they show up under their new name.
+        if user.is_placeholder():
+            return
 
-                if not exists:
-                    # Create new user by username.
-                    await sync_to_async(mdl.User.objects.create)(username = nuser["login"], parent = user.id, auto_added = True)
+        # Queue seeding from this user's followers.
+        if seed:
+            await self.enqueue_job(mdl.Job(kind = "seed_page", user = user), batch)
 
-                    if int(await self.get_setting("verbose")) >= 3:
-                        print("[V] Adding user " + nuser["login"] + " (parent " + user.username + ")")
+        await self.loop_and_follow_targets(user, target_users, batch)
 
-            # Increment page
-            page = page + 1
-            
-            await asyncio.sleep(float(random.randint(int(await self.get_setting("wait_time_list_min")), int(await self.get_setting("wait_time_list_max")))))
+    async def enqueue_job(self, job, batch = None):
+        if batch is not None:
+            batch.add_job(job)
+        else:
+            await self.jobs.enqueue([job])
+
+            self.notify_jobs()
+
+    async def flush_batch(self, batch):
+        queued = len(batch.jobs) > 0
+
+        await batch.flush()
+
+        if queued:
+            self.notify_jobs()
+
+    def notify_jobs(self):
+        for event in self.job_waiters:
+            event.set()
+
+    async def wait_jobs(self):
+        # Wait until this process queues jobs or JOB_POLL_TIME passes for jobs queued by other processes.
+        event = asyncio.Event()
+
+        self.job_waiters.add(event)
 
-    async def loop_and_follow_targets(self, user):
+        waits = [asyncio.ensure_future(event.wait()), asyncio.ensure_future(self.clock.sleep(JOB_POLL_TIME))]
+
+        try:
+            await asyncio.wait(waits, return_when = asyncio.FIRST_COMPLETED)
+        finally:
+            self.job_waiters.discard(event)
+
+            for wait in waits:
+                wait.cancel()
+
+    async def run_job(self, job, batch):
         import gf.models as mdl
 
-        # First, we should make sure we're following the target users.
-        target_users = await self.get_target_users()
+        # Returns False if the job failed and should be retried.
+        if job.kind in ["follow", "unfollow"] and job.user.is_placeholder():
+            # Nothing is sent for users we don't know the username of. Their following entry is kept unpurged so the purge loop queues unfollowing them again once they show up under their new name.
+            if job.kind == "unfollow":
+                batch.add(mdl.Following.objects.filter(target_user = job.target_user, user = job.user).update, purged = False)
 
-        for tuser in target_users:
-            # Check if user exists already.
-            exists = True
+            return True
+
+        if job.kind == "follow":
+            ok = await job.target_user.follow_user(job.user, batch)
+
+            await self.clock.sleep(self.get_follow_wait())
+
+            return ok
+
+        if job.kind == "unfollow":
+            ok = await job.target_user.unfollow_user(job.user, batch)
+
+            await self.clock.sleep(self.get_follow_wait())
+
+            return ok
+
+        if job.kind == "seed_page":
+            # Seeding may have been disabled since the job was queued.
+            if not self.conf.seed:
+                return True
+
+            ok = await self.retrieve_and_save_followers(job.user)
+
+            # Keep the list wait between the pages of consecutive seed jobs.
+            await self.clock.sleep(float(random.randint(self.conf.wait_time_list_min, self.conf.wait_time_list_max)))
+
+            return ok
+
+        print("[ERR] Unknown job kind " + job.kind + ".")
+
+        return False
+
+    async def renew_jobs(self, jobs):
+        # Jobs that are finished and written already are skipped by renew().
+        while True:
+            await self.clock.sleep(JOB_LEASE_TIME / 2)
 
             try:
-                fuser = await self.get_filtered(mdl.Following, {"target_user": tuser, "user": user})
-                fuser = fuser[0]
-            except Exception:
-                exists = False
+                await self.jobs.renew(jobs, self.clock.now(), JOB_LEASE_TIME)
+            except Exception as e:
+                print("[ERR] Failed to renew job leases.")
+                print(e)
+
+    async def run_jobs(self, kinds):
+        loop = "jobs:" + ",".join(kinds)
 
-            if exists and fuser is None:
-                exists = False
+        while True:
+            start = self.start_cycle(loop)
+
+            max_jobs = max(self.conf.max_scan_users, 1)
+
+            # Claim the next jobs with a lease long enough to cover the waits between them.
+            jobs = await self.jobs.claim(kinds, max_jobs, self.clock.now(), JOB_LEASE_TIME + (max_jobs * self.conf.wait_time_follow_max * self.shard.count), self.shard)
+
+            # Idle polls end here without any more trips to the database thread.
+            if len(jobs) < 1:
+                self.end_cycle(loop, start)
+
+                await self.wait_jobs()
 
-            # Check if we exist in the following list.
-            if exists:
                 continue
 
-            # Follow target user.
-            await tuser.follow_user(user)
+            # Users may have been followed by another worker since they were queued (e.g. before shards were rebalanced) or started following the target user. Only the leader syncs followers so this is how other workers' indexes learn about them.
+            followed = await self.get_followed(jobs)
 
-            await asyncio.sleep(float(random.randint(int(await self.get_setting("wait_time_follow_min")), int(await self.get_setting("wait_time_follow_max")))))
+            # Follows, unfollows and job results are written together.
+            batch = DB_Batch()
 
-    async def parse_user(self, user):
-        if bool(int(await self.get_setting("seed"))) and not self.locked:
-            if self.retrieve_and_save_task is None or self.retrieve_and_save_task.done():
-                self.retrieve_and_save_task = asyncio.create_task(self.retrieve_and_save_followers(user))
-        else:
-            if self.retrieve_and_save_task is not None and self.retrieve_and_save_task in asyncio.all_tasks():
-                self.retrieve_and_save_task.cancel()
-                self.retrieve_and_save_task = None
+            done = []
+            failed = []
+            finished = set()
+
+            # Keep the lease of our jobs while we work through them. A job may wait out a rate limit reset for up to an hour.
+            renew = asyncio.create_task(self.renew_jobs(jobs))
+
+            try:
+                for job in jobs:
+                    if job.kind == "follow" and (job.target_user_id, job.user_id) in followed:
+                        if followed[(job.target_user_id, job.user_id)]:
+                            self.note_following(job.target_user, job.user)
+                        else:
+                            self.note_followers(job.target_user, [job.user_id])
+
+                        done.append(job)
+                    elif await self.run_job(job, batch):
+                        done.append(job)
+                    else:
+                        failed.append(job)
+
+                    finished.add(job.id)
+
+                    if batch.is_due(BATCH_FLUSH_TIME):
+                        batch.add(self.jobs.finish, done, failed, self.clock.now())
+
+                        await batch.flush()
+
+                        done = []
+                        failed = []
+            finally:
+                renew.cancel()
+
+                batch.add(self.jobs.finish, done, failed, self.clock.now())
+
+                # Jobs we didn't get to (e.g. the worker was stopped) go back to the queue.
+                batch.add(self.jobs.release, [job for job in jobs if job.id not in finished])
 
-        follow_targets_task = asyncio.create_task(self.loop_and_follow_targets(user))
+                await batch.flush()
 
-        await asyncio.gather(follow_targets_task)
+            self.end_cycle(loop, start)
 
     async def purge_following(self):
         import gf.models as mdl
 
         secs_in_day = 86400
 
+        # Oldest unpurged follow of each target user (None if it isn't following anybody) and when we last checked. Deadlines are worked out from the current cleanup days on each pass so changes to them apply right away.
+        first_added = {}
+        checked = {}
+
         while True:
+            start = self.start_cycle("purge_following")
+
             # Retrieve target users.
             target_users = await self.get_target_users()
 
+            # Earliest deadline of all target users.
+            next_check = None
+
             # Loop through target users.
             for tuser in target_users:
                 # Make sure cleanup days is above 0 (enabled).
                 if tuser.cleanup_days < 1:
+                    first_added.pop(tuser.pk, None)
+                    checked.pop(tuser.pk, None)
+
                     continue
 
-                # Retrieve the target user's following list.
-                users = None
+                # Skip target users whose next expiry hasn't passed yet.
+                now = self.clock.time()
 
-                try:
-                    users = await self.get_filtered(mdl.Following, {"target_user": tuser, "purged": False}, related = ('user'), sort = ('time_added'))
-                except Exception:
-                    users = None
+                if tuser.pk in checked:
+                    deadline = self.get_purge_deadline(tuser, first_added[tuser.pk], checked[tuser.pk])
 
-                # Make sure we have users and loop.
-                if users is not None:
-                    for user in users:
-                        now = datetime.datetime.now().timestamp()
-                        expired = user.time_added.timestamp() + (tuser.cleanup_days * secs_in_day)
+                    if deadline > now:
+                        next_check = deadline if next_check is None else min(next_check, deadline)
 
-                        # Check if we're expired.
-                        if now > expired:
-                            if int(await self.get_setting("verbose")) >= 3:
-                                print("[VVV] " + user.user.username + " has expired.")
+                        continue
 
-                            # Unfollow used and mark them as purged.
-                            await tuser.unfollow_user(user.user)
+                # Retrieve only the expired entries of the target user's following list.
+                users = await self.get_expired_following(tuser, now - (tuser.cleanup_days * secs_in_day))
 
-                            # Set purged to true.
-                            user.purged = True
+                # Queue unfollowing the expired users and mark them as purged in one transaction.
+                batch = DB_Batch()
 
-                            # Save user.
-                            await sync_to_async(user.save)()
+                for user in users:
+                    if self.conf.verbose >= 3:
+                        print("[VVV] " + user.user.username + " has expired.")
 
-                            # Wait follow time.
-                            await asyncio.sleep(float(random.randint(int(await self.get_setting("wait_time_follow_min")), int(await self.get_setting("wait_time_follow_max")))))
+                    await self.enqueue_job(mdl.Job(kind = "unfollow", target_user = tuser, user = user.user), batch)
 
-            await asyncio.sleep(float(random.randint(int(await self.get_setting("wait_time_list_min")), int(await self.get_setting("wait_time_list_max")))))
-        
-    async def retrieve_followers(self):
-        import gf.models as mdl
+                    # Set purged to true even if unfollowing is disabled or fails.
+                    batch.set_purged(tuser, user.user)
 
-        while True:
-            await asyncio.sleep(1)
+                await self.flush_batch(batch)
 
-            tusers = await self.get_target_users()
+                # Remember the next entry to expire.
+                first = await self.get_first_following(tuser)
 
-            for user in tusers:
-                # Use GitHub API.
-                if self.api is None:
-                    self.api = ga.GH_API()
+                first_added[tuser.pk] = None if first is None else first.timestamp()
+                checked[tuser.pk] = self.clock.time()
 
-                # Authenticate.
-                self.api.authenticate(user.user.username, user.token)
-                
-                page = 1
+                deadline = self.get_purge_deadline(tuser, first_added[tuser.pk], checked[tuser.pk])
 
-                # We'll want to create a loop through of the target user's followers.
-                while True:
-                    res = None
+                next_check = deadline if next_check is None else min(next_check, deadline)
 
-                    # Make connection.
-                    try:
-                        res = await self.api.send("GET", '/user/followers?page=' + str(page))
-                    except Exception as e:
-                        print("[ERR] Failed to retrieve target user's followers list for " + user.user.username + " (request failure).")
-                        print(e)
+            # Drop old finished jobs and cached responses.
+            await self.jobs.prune(self.clock.now())
+            await self.prune_cache(self.clock.now())
 
-                        await self.do_fail()
+            self.end_cycle("purge_following", start)
 
-                        break
+            # Sleep until the next expiry. Target users are read again each pass so new ones and changed cleanup days are picked up within the max wait.
+            wait = PURGE_MAX_WAIT
 
-                    # Check status code.
-                    if res[1] != 200 and res[1] != 204:
-                        await self.do_fail()
+            if next_check is not None:
+                wait = min(max(next_check - self.clock.time(), 1.0), PURGE_MAX_WAIT)
 
-                        break
+            await self.clock.sleep(wait)
 
-                    # Decode JSON.
-                    try:
-                        data = json.loads(res[0])
-                    except json.JSONDecodeError as e:
-                        print("[ERR] Failed to retrieve target user's followers list for " + user.user.username + " (JSON decode failure).")
-                        print(e)
+    def get_purge_deadline(self, tuser, first_added, checked):
+        # If the target user isn't following anybody, check back after the max wait.
+        if first_added is None:
+            return checked + PURGE_MAX_WAIT
 
-                        break
+        return first_added + (tuser.cleanup_days * 86400)
 
-                    # Make sure we have data, if not, break the loop.
-                    if len(data) < 1:
-                        break
+    async def retrieve_followers(self):
+        # Follower sync worker of each target user.
+        workers = {}
 
-                    for fuser in data:
-                        if "id" not in fuser:
-                            continue
+        # Limit how many workers send requests at once.
+        self.sync_slots = asyncio.Semaphore(max(self.conf.max_sync_workers, 1))
 
-                        # Make sure user exists.
-                        exists = True
+        try:
+            while True:
+                tusers = await self.get_target_users()
 
-                        muser = None
+                # Workers read the latest copy of their target user from here.
+                self.target_users = {}
 
-                        try:
-                            muser = await self.get_filtered(mdl.User, {"username": fuser["login"]})
-                            muser = muser[0]
-                        except Exception:
-                            exists = False
+                for user in tusers:
+                    self.target_users[user.pk] = user
 
-                        if exists and muser is None:
-                            exists = False
+                # Stop workers of removed target users.
+                for pk in list(workers.keys()):
+                    if pk not in self.target_users:
+                        workers.pop(pk).cancel()
 
-                        if not exists:
-                            muser = await sync_to_async(mdl.User.objects.create)(username = fuser["login"], needs_parsing = False)
+                # Start workers for new target users and restart stopped ones.
+                for pk, user in self.target_users.items():
+                    task = workers.get(pk)
 
-                        # Add to follower list if not already on it.
-                        exists = True
+                    if task is not None and not task.done():
+                        continue
 
-                        try:
-                            tmp = await self.get_filtered(mdl.Follower, {"target_user": user, "user": muser})
-                            tmp = tmp[0]
-                        except Exception:
-                            exists = False
+                    if task is not None:
+                        self.add_restart("sync_followers")
 
-                        if exists and tmp is None:
-                            exists = False
+                        if not task.cancelled() and task.exception() is not None:
+                            print("[ERR] Follower sync for " + user.user.username + " stopped. Restarting.")
+                            print(task.exception())
 
-                        await sync_to_async(user.save)()
+                    workers[pk] = asyncio.create_task(self.sync_followers(pk))
 
-                        # Make a new follower entry.
-                        if not exists:
-                            await sync_to_async(mdl.Follower.objects.create)(target_user = user, user = muser)
+                await self.clock.sleep(SYNC_SUPERVISE_TIME)
+        finally:
+            for task in workers.values():
+                task.cancel()
 
-                        # Check if the same user is following our target.
-                        exists = True
+    async def sync_followers(self, pk):
+        import gf.models as mdl
 
-                        try:
-                            tmp = await self.get_filtered(mdl.Following, {"target_user": user, "user": muser, "purged": False})
-                            tmp = tmp[0]
-                        except Exception:
-                            exists = False
+        while True:
+            # Wait between passes like between pages. Unchanged pages are answered with 304 but each pass is still a request.
+            await self.clock.sleep(max(float(random.randint(self.conf.wait_time_list_min, self.conf.wait_time_list_max)), 1.0))
 
-                        if exists and tmp is None:
-                            exists = False
-                        
-                        # Check if target user is following this user.
-                        if exists:
-                            #  Check for remove following setting. If enabled, unfollow user.
-                            if user.remove_following:
-                                await user.unfollow_user(muser)
+            # Use the latest copy of the target user.
+            user = self.target_users.get(pk)
 
-                                # We'll want to wait the follow period.
-                                await asyncio.sleep(float(random.randint(int(await self.get_setting("wait_time_follow_min")), int(await self.get_setting("wait_time_follow_max")))))
+            if user is None:
+                return
 
-                    # Increment page
-                    page = page + 1
+            loop = "retrieve_followers:" + user.user.username
 
-                    await asyncio.sleep(float(random.randint(int(await self.get_setting("wait_time_list_min")), int(await self.get_setting("wait_time_list_max")))))
-        
-    async def parse_users(self):
-        import gf.models as mdl
+            start = self.start_cycle(loop)
 
-        while True:
-            # Retrieve users.
-            target_users = await self.get_target_users()
-            max_users = int(await self.get_setting("max_scan_users"))
+            # Use the target user's own GitHub API client.
+            api = self.get_api(user)
+
+            # We'll want to create a loop through of the target user's followers.
+            try:
+                # Every page is requested again on the next pass so they're all cached.
+                async for data, page, next_page, after in self.iter_followers(api, slots = self.sync_slots, cached_pages = lambda page: True):
+                    # Save progress.
+                    self.sync_pages[pk] = page
+
+                    # Reconcile the whole page at once and retrieve the followers the target user is also following.
+                    async with self.sync_slots:
+                        ids, unfollow = await self.save_followers(user, data)
+
+                    # Keep the follow-state index up to date.
+                    self.note_followers(user, ids)
+
+                    #  Check for remove following setting. If enabled, queue unfollowing users. They're marked as purged once unfollowed.
+                    if user.remove_following and len(unfollow) > 0:
+                        batch = DB_Batch()
+
+                        for muser in unfollow:
+                            await self.enqueue_job(mdl.Job(kind = "unfollow", target_user = user, user = muser), batch)
 
-            # Loop for target GitHub usernames to exclude from parsing list.
-            gnames = []
+                        await self.flush_batch(batch)
 
-            for user in target_users:
-                gnames.append(user.user.username)
+                    if next_page is not None:
+                        await self.clock.sleep(float(random.randint(self.conf.wait_time_list_min, self.conf.wait_time_list_max)))
+            except ga.Page_Error as e:
+                print("[ERR] Failed to retrieve target user's followers list for " + user.user.username + " (request failure).")
+                print(e)
+
+                await self.do_fail(api)
+            except json.JSONDecodeError as e:
+                print("[ERR] Failed to retrieve target user's followers list for " + user.user.username + " (JSON decode failure).")
+                print(e)
+
+            self.end_cycle(loop, start)
+
+    async def parse_batch(self):
+        # Claim the next batch of users.
+        users = await self.claim_users(self.conf.max_scan_users)
+
+        target_users = await self.get_target_users()
 
-            # Retrieve users excluding target users.
-            users = await self.get_users(gnames)
+        # Look up the target users' relationships with the whole batch at once.
+        if self.conf.api_transport == "graphql":
+            await self.lookup_relations(users, target_users)
 
-            for user in users[:max_users]:
-                # Update last parsed.
-                user.last_parsed = make_aware(datetime.datetime.now())
+        # Keep up to a batch of seeding jobs queued. The seed worker runs them one at a time.
+        seed_slots = 0
 
+        if self.conf.seed and not self.locked:
+            seed_slots = len(users) - await self.jobs.count_pending("seed_page", self.shard)
+
+            # Seed jobs do nothing while we have enough free users so don't queue them.
+            if seed_slots > 0 and self.conf.seed_min_free > 0 and await self.count_free_users() > self.conf.seed_min_free:
+                seed_slots = 0
+
+        # Queued jobs and user updates of the whole batch are written together. Writes are also flushed once they're BATCH_FLUSH_TIME seconds old.
+        batch = DB_Batch()
+
+        try:
+            for user in users:
                 # Check if this user needed to seed.
                 if user.needs_to_seed:
                     user.needs_to_seed = False
 
-                # Save user.
-                await sync_to_async(user.save)()
+                    # Save user with the batch.
+                    batch.update(user, ["needs_to_seed"])
+
+                seed = seed_slots > 0 and self.should_seed(user)
 
                 # Parse user.
-                await self.parse_user(user)
+                await self.parse_user(user, target_users, batch, seed)
+
+                if seed:
+                    seed_slots = seed_slots - 1
+
+                misc.users_parsed.inc()
+
+                if batch.is_due(BATCH_FLUSH_TIME):
+                    await self.flush_batch(batch)
+        finally:
+            await self.flush_batch(batch)
+
+    async def parse_users(self):
+        while True:
+            start = self.start_cycle("parse_users")
+
+            await self.parse_batch()
+
+            self.end_cycle("parse_users", start)
 
             # Wait scan time.
-            await asyncio.sleep(float(random.randint(int(await self.get_setting("scan_time_min")), int(await self.get_setting("scan_time_max")))))
+            await self.clock.sleep(float(random.randint(self.conf.scan_time_min, self.conf.scan_time_max)))
             
     async def work(self):
         # Retrieve all target users
@@ -496,48 +954,101 @@ class Parser(threading.Thread):
                 self.global_token = user.token
 
         # Create a loop until the program ends.
+        try:
+            await self.loop()
+        finally:
+            # Stop tasks before closing the API clients' pooled connections with the event loop.
+            tasks = [task for task in [self.parse_users_task, self.retrieve_followers_task, self.purge_following_task, self.follow_jobs_task, self.seed_jobs_task] if task is not None]
+
+            for task in tasks:
+                task.cancel()
+
+            await asyncio.gather(*tasks, return_exceptions = True)
+
+            # Start over if work() is ran again (e.g. after regaining the parser lease).
+            self.parse_users_task = None
+            self.retrieve_followers_task = None
+            self.purge_following_task = None
+            self.follow_jobs_task = None
+            self.seed_jobs_task = None
+
+            await self.clients.close()
+
+    async def loop(self):
         while True:
             # Check if we're enabled.
-            if bool(int(await self.get_setting("enabled"))) and not self.locked:
+            if self.conf.enabled and not self.locked:
                 # Run parse users task.
                 if self.parse_users_task is None or self.parse_users_task.done():
+                    if self.parse_users_task is not None:
+                        self.add_restart("parse_users")
+
                     self.parse_users_task = asyncio.create_task(self.parse_users())
 
-                # Create tasks to check followers/following for target users.
-                if self.retrieve_followers_task is None or self.retrieve_followers_task.done():
-                    self.retrieve_followers_task = asyncio.create_task(self.retrieve_followers())
-                
-                if self.purge_following_task is None or self.purge_following_task.done():
-                    self.purge_following_task = asyncio.create_task(self.purge_following())
+                # Create tasks to check followers/following for target users. These only run in the leader process.
+                if not self.leader:
+                    self.stop_target_tasks()
+                else:
+                    if self.retrieve_followers_task is None or self.retrieve_followers_task.done():
+                        if self.retrieve_followers_task is not None:
+                            self.add_restart("retrieve_followers")
+
+                        self.retrieve_followers_task = asyncio.create_task(self.retrieve_followers())
+
+                    if self.purge_following_task is None or self.purge_following_task.done():
+                        if self.purge_following_task is not None:
+                            self.add_restart("purge_following")
+
+                        self.purge_following_task = asyncio.create_task(self.purge_following())
+
+                # Run job workers.
+                if self.follow_jobs_task is None or self.follow_jobs_task.done():
+                    if self.follow_jobs_task is not None:
+                        self.add_restart("follow_jobs")
+
+                    self.follow_jobs_task = asyncio.create_task(self.run_jobs(["follow", "unfollow"]))
+
+                if self.seed_jobs_task is None or self.seed_jobs_task.done():
+                    if self.seed_jobs_task is not None:
+                        self.add_restart("seed_jobs")
+
+                    self.seed_jobs_task = asyncio.create_task(self.run_jobs(["seed_page"]))
             else:
                 # Check tasks and make sure they're closed.
                 if self.parse_users_task in asyncio.all_tasks():
                     self.parse_users_task.cancel()
                     self.parse_users_task = None
 
-                if self.retrieve_and_save_task in asyncio.all_tasks():
-                    self.retrieve_and_save_task.cancel()
-                    self.retrieve_and_save_task = None
-                
-                if self.purge_following_task in asyncio.all_tasks():
-                    self.purge_following_task.cancel()
-                    self.purge_following_task = None
+                if self.follow_jobs_task in asyncio.all_tasks():
+                    self.follow_jobs_task.cancel()
+                    self.follow_jobs_task = None
+
+                if self.seed_jobs_task in asyncio.all_tasks():
+                    self.seed_jobs_task.cancel()
+                    self.seed_jobs_task = None
+
+                self.stop_target_tasks()
+
+            # Wait before checking the settings and tasks again.
+            await self.clock.sleep(LOOP_TIME)
 
-                if self.retrieve_followers_task is not None and self.retrieve_followers_task in asyncio.all_tasks():
-                    self.retrieve_followers_task.cancel()
-                    self.retrieve_followers_task = None
+    def stop_target_tasks(self):
+        if self.purge_following_task in asyncio.all_tasks():
+            self.purge_following_task.cancel()
+            self.purge_following_task = None
 
-            # Sleep for a second to avoid CPU consumption.
-            await asyncio.sleep(1)
+        if self.retrieve_followers_task is not None and self.retrieve_followers_task in asyncio.all_tasks():
+            self.retrieve_followers_task.cancel()
+            self.retrieve_followers_task = None
 
     async def run_locked(self):
-        wait_time = float(random.randint(int(await self.get_setting("lockout_wait_min")), int(await self.get_setting("lockout_wait_max"))) * 60)
+        wait_time = float(random.randint(self.conf.lockout_wait_min, self.conf.lockout_wait_max) * 60)
 
-        await asyncio.sleep(wait_time)
+        await self.clock.sleep(wait_time)
 
         self.locked = False
         self.running = True
-        self.api.fails = 0
+        self.clients.reset_fails()
 
     async def run_locked_task(self):
         asyncio.create_task(self.run_locked())
@@ -0,0 +1,65 @@
+import datetime
+
+from django.db.models import F
+from django.db.models.functions import Now
+
+from asgiref.sync import sync_to_async
+
+from .jobs import get_owner
+
+# Seconds a worker is considered alive for without sending a heartbeat.
+WORKER_TIME = 30
+
+class Shard():
+    def __init__(self, index = 0, count = 1):
+        self.index = index
+        self.count = count
+
+    def __eq__(self, other):
+        return isinstance(other, Shard) and self.index == other.index and self.count == other.count
+
+    def __str__(self):
+        return str(self.index + 1) + "/" + str(self.count)
+
+    def filter(self, qs, field = "id"):
+        # Only keep rows whose field (a user ID) falls into this shard. IDs never change so users stay in the same shard while the worker count does.
+        if self.count <= 1:
+            return qs
+
+        return qs.alias(shard = F(field) % self.count).filter(shard = self.index)
+
+class Worker_Registry():
+    def __init__(self, owner = None, ttl = WORKER_TIME, shards = 0, shard = 0):
+        self.owner = get_owner() if owner is None else owner
+        self.ttl = ttl
+
+        # Fixed shard assignment. If shards is 0, users are split between live workers instead.
+        self.shards = shards
+        self.shard = shard
+
+    @sync_to_async
+    def heartbeat(self, now = None):
+        import gf.models as mdl
+
+        # Without a time (outside of simulations) the DB's clock is used so hosts with skewed clocks agree on which workers are alive.
+        if now is None:
+            now = Now()
+
+        # Register ourselves and drop workers that stopped sending heartbeats.
+        mdl.Worker.objects.update_or_create(name = self.owner, defaults = {"heartbeat": now})
+        mdl.Worker.objects.filter(heartbeat__lt = now - datetime.timedelta(seconds = self.ttl)).delete()
+
+        if self.shards > 0:
+            return Shard(self.shard, self.shards)
+
+        # Our shard is our rank among the live workers. Shards are rebalanced as workers join or leave.
+        names = list(mdl.Worker.objects.order_by("name").values_list("name", flat = True))
+
+        return Shard(names.index(self.owner), len(names))
+
+    @sync_to_async
+    def leave(self):
+        import gf.models as mdl
+
+        # Let the other workers take over our shard right away.
+        mdl.Worker.objects.filter(name = self.owner).delete()
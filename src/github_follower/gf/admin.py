@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import User, Seeder, Setting, Target_User, Follower, Following
+from .models import User, Seeder, Setting, Target_User, Follower, Following, Job, Lease, Worker
 
 admin.site.register(User)
 admin.site.register(Target_User)
@@ -8,5 +8,8 @@ admin.site.register(Seeder)
 admin.site.register(Follower)
 admin.site.register(Following)
 admin.site.register(Setting)
+admin.site.register(Job)
+admin.site.register(Lease)
+admin.site.register(Worker)
 
 admin.site.site_header = 'GitHub FB Administration'
\ No newline at end of file
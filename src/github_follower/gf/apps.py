@@ -1,7 +1,5 @@
 from django.apps import AppConfig
-
-import back_bone as bb
-import os
+from django.db.models.signals import post_migrate
 
 class GfConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
@@ -10,30 +8,8 @@ class GfConfig(AppConfig):
 
 
     def ready(self):
-        env = os.environ.get("FIRST_THREAD")
-
-        # Check if first thread has started since we want to spin it up on the second thread in development.
-        if env is not None:
-            from .models import Setting
-
-            # Set settings. defaults.
-            Setting.create("enabled", "0", False)
-            Setting.create("max_scan_users", "10", False)
-            Setting.create("wait_time_follow_min", "10", False)
-            Setting.create("wait_time_follow_max", "30", False)
-            Setting.create("wait_time_list_min", "5", False)
-            Setting.create("wait_time_list_max", "30", False)
-            Setting.create("scan_time_min", "5", False)
-            Setting.create("scan_time_max", "60", False)
-            Setting.create("verbose", "1", False)
-            Setting.create("user_agent", "GitHub-Follower", False)
-            Setting.create("seed", "1", False)
-            Setting.create("seed_min_free", "64", False)
-            Setting.create("max_api_fails", "5", False)
-            Setting.create("lockout_wait_min", "1", False)
-            Setting.create("lockout_wait_max", "10", False)
-            Setting.create("seed_max_pages", "5", False)
+        # Connect setting change signals.
+        from . import signals
 
-            bb.parser.start()
-        else:
-            os.environ["FIRST_THREAD"] = 'True'
\ No newline at end of file
+        # Create default settings once the database is migrated. The parser runs in its own process through the run_parser command.
+        post_migrate.connect(signals.create_default_settings, sender = self)
@@ -0,0 +1,100 @@
+import json
+import os
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand, CommandError
+
+import github_api.decode as dec
+from github_api.fake import Fake_GitHub
+
+def read_pages(path):
+    # Recorded pages are the raw response bodies of follower pages saved as one JSON file each.
+    pages = []
+
+    for name in sorted(os.listdir(path)):
+        if name.endswith(".json"):
+            with open(os.path.join(path, name)) as f:
+                pages.append(f.read())
+
+    return pages
+
+def make_pages(cnt, per_page):
+    # Pages of the fake GitHub's user objects which mimic the size of GitHub's.
+    fake = Fake_GitHub(users = cnt * per_page)
+
+    return [json.dumps([fake.to_json("user" + str(i * per_page + j)) for j in range(per_page)]) for i in range(cnt)]
+
+def get_login(user):
+    return user["login"]
+
+def get_ref_login(ref):
+    return ref.login
+
+def measure(decode, login, pages, rounds):
+    # Decoding speed (including reading the logins like the crawl loops do) without tracemalloc's overhead.
+    start = time.perf_counter()
+
+    for _ in range(rounds):
+        for body in pages:
+            [login(user) for user in decode(body)]
+
+    elapsed = time.perf_counter() - start
+
+    # Peak memory while decoding a page and memory held by its decoded data while the crawl loop works through it.
+    peak = 0
+    held = 0
+
+    tracemalloc.start()
+
+    try:
+        for body in pages:
+            base = tracemalloc.get_traced_memory()[0]
+
+            tracemalloc.reset_peak()
+
+            data = decode(body)
+
+            current, page_peak = tracemalloc.get_traced_memory()
+
+            peak = peak + page_peak - base
+            held = held + current - base
+
+            del data
+    finally:
+        tracemalloc.stop()
+
+    return (len(pages) * rounds) / elapsed, peak / len(pages), held / len(pages)
+
+class Command(BaseCommand):
+    help = "Decodes follower pages as full JSON objects and as compact user records and reports pages/s and memory per page."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dir", help = "Directory of recorded follower pages (*.json). Pages are generated when not set.")
+        parser.add_argument("--pages", type = int, default = 200, help = "Pages to generate.")
+        parser.add_argument("--per-page", type = int, default = 100, help = "Users on each generated page.")
+        parser.add_argument("--rounds", type = int, default = 5, help = "Times each page is decoded for the pages/s figure.")
+
+    def handle(self, *args, **options):
+        if options["dir"]:
+            pages = read_pages(options["dir"])
+        else:
+            pages = make_pages(options["pages"], options["per_page"])
+
+        if len(pages) < 1:
+            raise CommandError("No pages to decode.")
+
+        decoders = [("json.loads (full objects)", json.loads, get_login), ("decode_users (json)", dec.decode_users_json, get_ref_login)]
+
+        if dec.orjson is not None:
+            decoders.append(("orjson.loads (full objects)", dec.orjson.loads, get_login))
+            decoders.append(("decode_users (orjson)", dec.decode_users_orjson, get_ref_login))
+        else:
+            self.stdout.write("orjson isn't installed so only the json module is measured.")
+
+        self.stdout.write("Decoding " + str(len(pages)) + " pages (" + format(sum(len(body) for body in pages) / len(pages) / 1024, ".1f") + " KB each) " + str(options["rounds"]) + " times.")
+
+        for name, decode, login in decoders:
+            rate, peak, held = measure(decode, login, pages, options["rounds"])
+
+            self.stdout.write(name + ": " + format(rate, ".1f") + " pages/s, " + format(peak / 1024, ".1f") + " KB peak and " + format(held / 1024, ".1f") + " KB held per page")
@@ -0,0 +1,176 @@
+import asyncio
+import resource
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from asgiref.sync import sync_to_async
+
+import back_bone
+import misc
+
+from github_api.fake import Fake_GitHub
+
+# Settings used while benchmarking. All waits are disabled.
+BENCH_SETTINGS = {
+    "enabled": "1",
+    "max_scan_users": "50",
+    "wait_time_follow_min": "0",
+    "wait_time_follow_max": "0",
+    "wait_time_list_min": "0",
+    "wait_time_list_max": "0",
+    "scan_time_min": "0",
+    "scan_time_max": "0",
+    "verbose": "0",
+    "seed": "1",
+    "seed_min_free": "0",
+    "max_api_fails": "0",
+    "lockout_wait_min": "0",
+    "lockout_wait_max": "0",
+    "seed_max_pages": "5"
+}
+
+def add_arguments(parser):
+    parser.add_argument("--seconds", type = float, default = 30.0, help = "How long to run the parser for.")
+    parser.add_argument("--users", type = int, default = 10000, help = "Users in the fake social graph.")
+    parser.add_argument("--followers", type = int, default = 50, help = "Followers of each fake user.")
+    parser.add_argument("--targets", type = int, default = 1, help = "Target users to create.")
+    parser.add_argument("--seeders", type = int, default = 1, help = "Seed users to create.")
+    parser.add_argument("--latency", type = float, default = 0.0, help = "Seconds of latency added to each fake API response.")
+    parser.add_argument("--error-rate", type = float, default = 0.0, help = "Chance of a fake API response being a 500 error.")
+    parser.add_argument("--rate-limit", type = int, default = 0, help = "Fake API requests allowed per credential and hour (0 = unlimited).")
+    parser.add_argument("--virtual", action = "store_true", help = "Run on a virtual clock that fast-forwards through waits. --seconds is then virtual time.")
+    parser.add_argument("--set", action = "append", default = [], metavar = "KEY=VAL", help = "Override a bot setting.")
+
+def setup_database(options):
+    import gf.models as mdl
+    from gf.registry import registry
+
+    for key, val in BENCH_SETTINGS.items():
+        # Simulations on the virtual clock keep the default wait times and seeding limit. Loops without waits would never let it move forward.
+        if options["virtual"] and (key.startswith("wait_time_") or key.startswith("scan_time_") or key.startswith("lockout_wait_") or key == "seed_min_free"):
+            continue
+
+        mdl.Setting.create(key, val, True)
+
+    for item in options["set"]:
+        key, val = item.split("=", 1)
+
+        mdl.Setting.create(key, val, True)
+
+    # Target users are named after the fake graph's users so they have followers.
+    for i in range(options["targets"]):
+        user = mdl.User.objects.create(username = "user" + str(i), needs_parsing = False)
+
+        mdl.Target_User.objects.create(user = user, cleanup_days = 0, token = "token" + str(i), global_user = (i == 0))
+
+    for i in range(options["seeders"]):
+        user = mdl.User.objects.create(username = "user" + str(options["targets"] + i), needs_to_seed = True)
+
+        mdl.Seeder.objects.create(user = user)
+
+    registry.load()
+
+class Bench_Run():
+    def __init__(self, options):
+        self.options = options
+
+        # The fake GitHub's rate limit windows and the parser's waits run on the same clock.
+        self.clock = back_bone.Virtual_Clock() if options["virtual"] else None
+
+        self.fake = Fake_GitHub(users = options["users"], followers = options["followers"], latency = options["latency"], error_rate = options["error_rate"], rate_limit = options["rate_limit"], clock = self.clock)
+
+        self.elapsed = 0.0
+        self.real_elapsed = 0.0
+        self.queries = 0
+
+    async def run(self):
+        # Point the API clients at the fake GitHub.
+        settings.GH_API_ENDPOINT = self.fake.start_thread()
+
+        await sync_to_async(setup_database)(self.options)
+
+        parser = back_bone.parser
+
+        clock = self.clock
+
+        if clock is not None:
+            parser.set_clock(clock)
+
+        queries = sum(misc.counter.counts.values())
+        start = parser.clock.time()
+        real_start = time.monotonic()
+
+        task = asyncio.create_task(parser.work())
+
+        try:
+            # On the virtual clock this sleeps virtual seconds too.
+            await asyncio.sleep(self.options["seconds"])
+        finally:
+            task.cancel()
+
+            await asyncio.gather(task, return_exceptions = True)
+
+            self.elapsed = parser.clock.time() - start
+            self.real_elapsed = time.monotonic() - real_start
+            self.queries = sum(misc.counter.counts.values()) - queries
+
+            self.fake.stop_thread()
+
+    def start(self):
+        if self.clock is None:
+            return asyncio.run(self.run())
+
+        # Requests to the fake GitHub run outside the event loop so the clock waits for them before fast-forwarding.
+        return self.clock.run(self.run(), busy = lambda: back_bone.parser.clients.pending() > 0)
+
+    def report(self):
+        stats = self.fake.stats
+
+        follows = stats.get("PUT /user/following/:user", 0)
+        unfollows = stats.get("DELETE /user/following/:user", 0)
+        pages = stats.get("GET /user/followers", 0) + stats.get("GET /users/:user/followers", 0) + stats.get("POST /graphql", 0)
+
+        ops = max(follows + unfollows + pages, 1)
+
+        # Max RSS is reported in kilobytes on Linux.
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+        lines = []
+
+        lines.append("Ran for " + format(self.elapsed, ".1f") + " seconds (" + format(self.real_elapsed, ".1f") + " real seconds).")
+        lines.append("Follows/s: " + format(follows / self.elapsed, ".1f") + " (" + str(follows) + " follows, " + str(unfollows) + " unfollows)")
+        lines.append("Pages/s: " + format(pages / self.elapsed, ".1f") + " (" + str(pages) + " pages)")
+        lines.append("DB queries/operation: " + format(self.queries / ops, ".2f") + " (" + str(self.queries) + " queries)")
+        lines.append("Peak RSS: " + format(rss, ".1f") + " MB")
+
+        for route, cnt in sorted(stats.items()):
+            lines.append("  " + route + ": " + str(cnt))
+
+        return "\n".join(lines)
+
+def run_on_test_database(func):
+    # Use a throwaway database so the real one isn't touched.
+    old_name = connection.settings_dict["NAME"]
+
+    connection.creation.create_test_db(verbosity = 0, autoclobber = True, serialize = False)
+
+    try:
+        return func()
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity = 0)
+
+class Command(BaseCommand):
+    help = "Runs the parser against a fake GitHub API with waits disabled and reports its throughput."
+
+    def add_arguments(self, parser):
+        add_arguments(parser)
+
+    def handle(self, *args, **options):
+        run = Bench_Run(options)
+
+        run_on_test_database(run.start)
+
+        self.stdout.write(run.report())
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+
+import misc
+
+from .benchmark import Bench_Run, add_arguments, run_on_test_database
+
+class Command(BaseCommand):
+    help = "Runs the parser against a fake GitHub API with tracing enabled and reports where the time went by span."
+
+    def add_arguments(self, parser):
+        add_arguments(parser)
+
+        parser.add_argument("--output", default = "parser.folded", help = "File to write folded stacks to (flamegraph.pl or speedscope). Use - to skip.")
+        parser.add_argument("--top", type = int, default = 30, help = "Spans shown in the summary (0 = all).")
+
+    def handle(self, *args, **options):
+        run = Bench_Run(options)
+
+        misc.tracer.reset()
+        misc.tracer.enable()
+
+        try:
+            run_on_test_database(run.start)
+        finally:
+            misc.tracer.disable()
+
+        self.stdout.write(run.report())
+        self.stdout.write("")
+        self.stdout.write(misc.tracer.summary(options["top"]))
+
+        if options["output"] != "-":
+            with open(options["output"], "w") as f:
+                f.write(misc.tracer.folded())
+
+            self.stdout.write("")
+            self.stdout.write("Wrote folded stacks to " + options["output"] + ".")
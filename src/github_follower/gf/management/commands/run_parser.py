@@ -0,0 +1,200 @@
+import asyncio
+import signal
+import time
+
+from aiohttp import web
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from asgiref.sync import sync_to_async
+
+import back_bone
+import misc
+
+# Seconds between heartbeats, lease renewals and settings reloads.
+RENEW_TIME = 10
+
+class Parser_Runner():
+    def __init__(self, options):
+        self.options = options
+
+        self.parser = back_bone.parser
+        self.lease = back_bone.Leader_Lease(options["lease"])
+        self.workers = back_bone.Worker_Registry(shards = options["shards"], shard = options["shard"])
+
+        self.task = None
+
+        # When our last successful lease renewal and heartbeat run out.
+        self.held_until = 0.0
+        self.alive_until = 0.0
+
+        self.metrics_runner = None
+
+    async def get_metrics(self, request):
+        # Same token as the web interface's /metrics, unless we're only listening locally with none set.
+        token = getattr(settings, "METRICS_TOKEN", "")
+
+        if (token or self.options["metrics_host"] not in ["127.0.0.1", "localhost", "::1"]) and not misc.check_token(request.headers.get("Authorization", ""), token):
+            return web.Response(status = 403)
+
+        try:
+            await sync_to_async(self.parser.update_queue_metrics)()
+        except Exception as e:
+            print("[ERR] Failed to update parse queue metrics.")
+            print(e)
+
+        return web.Response(text = misc.stats.render(), content_type = "text/plain", charset = "utf-8")
+
+    async def start_metrics(self):
+        # The web interface's /metrics only sees its own process so the parser's metrics are served from here.
+        app = web.Application()
+        app.router.add_get("/metrics", self.get_metrics)
+
+        self.metrics_runner = web.AppRunner(app)
+
+        await self.metrics_runner.setup()
+
+        site = web.TCPSite(self.metrics_runner, self.options["metrics_host"], self.options["metrics_port"])
+
+        await site.start()
+
+        print("Serving metrics on http://" + self.options["metrics_host"] + ":" + str(self.options["metrics_port"]) + "/metrics")
+
+    async def stop_parser(self):
+        if self.task is None:
+            return
+
+        self.task.cancel()
+
+        await asyncio.gather(self.task, return_exceptions = True)
+
+        self.task = None
+
+    async def tick(self):
+        from gf.registry import registry
+
+        # Setting change signals only fire in the process that made the change so reload them here.
+        try:
+            await sync_to_async(registry.load)()
+        except Exception as e:
+            print("[ERR] Failed to reload settings.")
+            print(e)
+
+        # Expiry is counted from before each request so we give up before the other workers consider it run out.
+        try:
+            sent = time.monotonic()
+            shard = await self.workers.heartbeat()
+
+            self.alive_until = sent + self.workers.ttl
+
+            self.parser.set_shard(shard)
+        except Exception as e:
+            print("[ERR] Failed to send worker heartbeat.")
+            print(e)
+
+        try:
+            sent = time.monotonic()
+
+            if await self.lease.acquire():
+                self.held_until = sent + self.lease.ttl
+        except Exception as e:
+            print("[ERR] Failed to renew the parser lease.")
+            print(e)
+
+        # Keep working through DB errors until our heartbeat or lease would have run out.
+        alive = time.monotonic() < self.alive_until
+        held = time.monotonic() < self.held_until
+
+        if held != self.parser.leader:
+            if held:
+                print("Took the " + self.lease.name + " lease. Running target user loops.")
+            else:
+                print("[ERR] Lost the " + self.lease.name + " lease. Stopping target user loops.")
+
+            self.parser.set_leader(held)
+
+        if alive and (self.task is None or self.task.done()):
+            if self.task is not None:
+                self.parser.add_restart("parser")
+
+                if not self.task.cancelled() and self.task.exception() is not None:
+                    print("[ERR] Parser stopped. Restarting.")
+                    print(self.task.exception())
+
+            print("Parser is running...")
+
+            self.task = asyncio.create_task(self.parser.work())
+        elif not alive and self.task is not None:
+            # The other workers took over our shard by now.
+            print("[ERR] Worker heartbeat expired. Stopping until it can be sent again.")
+
+            await self.stop_parser()
+
+    async def run(self):
+        stop = asyncio.Event()
+
+        # Shut down cleanly on Ctrl+C and when the service manager stops us.
+        loop = asyncio.get_running_loop()
+
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except NotImplementedError:
+                pass
+
+        if self.options["metrics_port"] > 0:
+            await self.start_metrics()
+
+        # Only the lease holder runs the target user loops.
+        self.parser.set_leader(False)
+
+        print("Starting worker " + self.workers.owner + "...")
+
+        try:
+            while not stop.is_set():
+                await self.tick()
+
+                try:
+                    await asyncio.wait_for(stop.wait(), RENEW_TIME)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            await self.stop_parser()
+
+            try:
+                await self.lease.release()
+            except Exception as e:
+                print("[ERR] Failed to release the parser lease.")
+                print(e)
+
+            try:
+                await self.workers.leave()
+            except Exception as e:
+                print("[ERR] Failed to remove worker.")
+                print(e)
+
+            if self.metrics_runner is not None:
+                await self.metrics_runner.cleanup()
+
+class Command(BaseCommand):
+    help = "Runs a parser worker. Users are split into shards between workers and the worker holding the parser lease also runs the target user loops."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--lease", default = "parser", help = "Name of the lease held by the worker running the target user loops.")
+        parser.add_argument("--shards", type = int, default = 0, help = "Fixed number of shards to split users into (0 = one per live worker).")
+        parser.add_argument("--shard", type = int, default = 0, help = "Fixed shard of this worker starting at 0 (used with --shards).")
+        parser.add_argument("--metrics-host", default = "127.0.0.1", help = "Address to serve the parser's metrics on.")
+        parser.add_argument("--metrics-port", type = int, default = 0, help = "Port to serve the parser's metrics on (0 = disabled).")
+
+    def handle(self, *args, **options):
+        from gf.registry import registry
+
+        if options["shards"] < 0 or options["shard"] < 0 or (options["shards"] > 0 and options["shard"] >= options["shards"]):
+            raise CommandError("--shard must be between 0 and --shards - 1.")
+
+        # Make sure every setting exists and load them.
+        registry.create_defaults()
+        registry.load()
+
+        asyncio.run(Parser_Runner(options).run())
@@ -0,0 +1,17 @@
+# Generated by Django 4.0.1 on 2026-10-18 18:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gf', '0010_remove_user_gid'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['needs_parsing', 'needs_to_seed', 'last_parsed'], name='user-parse-queue'),
+        ),
+    ]
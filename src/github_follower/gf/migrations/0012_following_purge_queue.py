@@ -0,0 +1,17 @@
+# Generated by Django 4.0.1 on 2026-10-18 19:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gf', '0011_user_parse_queue'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='following',
+            index=models.Index(fields=['target_user', 'purged', 'time_added'], name='following-purge-queue'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.0.1 on 2026-10-18 19:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gf', '0012_following_purge_queue'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Response_Cache',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('credential', models.CharField(editable=False, max_length=64)),
+                ('url', models.CharField(editable=False, max_length=255)),
+                ('etag', models.CharField(blank=True, default='', editable=False, max_length=255)),
+                ('last_modified', models.CharField(blank=True, default='', editable=False, max_length=64)),
+                ('body', models.TextField(editable=False)),
+                ('time_updated', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Response Cache',
+                'constraints': [models.UniqueConstraint(fields=('credential', 'url'), name='response-cache-key')],
+            },
+        ),
+    ]
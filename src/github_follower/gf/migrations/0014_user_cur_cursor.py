@@ -0,0 +1,18 @@
+# Generated by Django 4.0.1 on 2026-10-18 20:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gf', '0013_response_cache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='cur_cursor',
+            field=models.CharField(blank=True, default='', editable=False, max_length=128),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.0.1 on 2026-10-18 20:48
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gf', '0014_user_cur_cursor'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='following',
+            name='time_added',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
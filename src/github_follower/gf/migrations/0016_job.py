@@ -0,0 +1,33 @@
+# Generated by Django 4.0.1 on 2026-10-18 21:10
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gf', '0015_following_time_added'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('follow', 'Follow'), ('unfollow', 'Unfollow'), ('seed_page', 'Seed Page')], editable=False, max_length=16)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='queued', editable=False, max_length=16)),
+                ('lease_until', models.DateTimeField(editable=False, null=True)),
+                ('attempts', models.IntegerField(default=0, editable=False)),
+                ('owner', models.CharField(blank=True, default='', editable=False, max_length=128)),
+                ('time_added', models.DateTimeField(default=django.utils.timezone.now, editable=False)),
+                ('target_user', models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.CASCADE, to='gf.target_user')),
+                ('user', models.ForeignKey(editable=False, on_delete=django.db.models.deletion.CASCADE, to='gf.user')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'kind', 'lease_until'], name='job-claim-queue')],
+                'constraints': [models.UniqueConstraint(condition=models.Q(('status__in', ['queued', 'running']), ('target_user__isnull', False)), fields=('kind', 'target_user', 'user'), name='job-pending'), models.UniqueConstraint(condition=models.Q(('status__in', ['queued', 'running']), ('target_user__isnull', True)), fields=('kind', 'user'), name='job-pending-seed')],
+            },
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.0.1 on 2026-10-18 21:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gf', '0016_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Lease',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(editable=False, max_length=64, unique=True)),
+                ('owner', models.CharField(blank=True, default='', editable=False, max_length=128)),
+                ('lease_until', models.DateTimeField(editable=False, null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.0.1 on 2026-10-18 22:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gf', '0017_lease'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Worker',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(editable=False, max_length=128, unique=True)),
+                ('heartbeat', models.DateTimeField(editable=False)),
+            ],
+        ),
+    ]
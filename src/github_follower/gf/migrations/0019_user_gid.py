@@ -0,0 +1,18 @@
+# Generated by Django 4.0.1 on 2026-10-18 23:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gf', '0018_worker'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='gid',
+            field=models.BigIntegerField(editable=False, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.0.1 on 2026-10-19 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gf', '0019_user_gid'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='last_seeded',
+            field=models.DateTimeField(editable=False, null=True),
+        ),
+    ]
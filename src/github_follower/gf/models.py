@@ -1,12 +1,17 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Value
+from django.db.models.functions import Cast, Concat
+from django.utils import timezone
 import json
 import http.client
 
 import back_bone
+import misc
 
 import asyncio
 
-import github_api as ga
+
+from .registry import registry
 
 from asgiref.sync import sync_to_async
 
@@ -61,6 +66,9 @@ class Setting(models.Model):
 class User(models.Model):
     parent = models.IntegerField(editable = False, default = 0, null = True)
 
+    # GitHub's numeric user ID. Usernames may change so users are matched by this. Users added through the admin center get it the first time they show up in a followers list.
+    gid = models.BigIntegerField(editable = False, null = True, unique = True)
+
     username = models.CharField(verbose_name = "Username", help_text = "The GitHub username.", max_length = 64, unique = True)
 
     last_parsed = models.DateTimeField(editable = False, auto_now_add = False, null = True)
@@ -70,6 +78,113 @@ class User(models.Model):
     auto_added = models.BooleanField(editable = False, default = False)
 
     cur_page = models.IntegerField(editable = False, default = 1)
+    cur_cursor = models.CharField(editable = False, max_length = 128, blank = True, default = "")
+
+    # When the user's followers were last seeded from.
+    last_seeded = models.DateTimeField(editable = False, null = True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields = ['needs_parsing', 'needs_to_seed', 'last_parsed'], name = "user-parse-queue")
+        ]
+
+    def match(refs, **defaults):
+        # Matches User_Refs (GitHub ID and login) to users by GitHub ID and creates missing users with defaults. Returns the users in order and the ones created.
+        refs = list({ref.id: ref for ref in refs}.values())
+
+        if len(refs) < 1:
+            return [], []
+
+        logins = {ref.login: ref for ref in refs}
+
+        with transaction.atomic():
+            by_gid = {user.gid: user for user in User.objects.filter(gid__in = [ref.id for ref in refs])}
+            by_name = {user.username: user for user in User.objects.filter(username__in = list(logins.keys()))}
+
+            # Users added through the admin center as target users or seeders before we knew their ID. Their username is taken by another user with the ID if they were also seen under an old name.
+            added = [user.pk for login, user in by_name.items() if user.gid is None and logins[login].id in by_gid]
+            keep = set()
+
+            if len(added) > 0:
+                keep.update(Target_User.objects.filter(user__in = added).values_list("user_id", flat = True))
+                keep.update(Seeder.objects.filter(user__in = added).values_list("user_id", flat = True))
+
+            matched = {}
+            changed = []
+
+            for ref in refs:
+                user = by_gid.get(ref.id)
+                named = by_name.get(ref.login)
+
+                # Users without a GitHub ID yet are matched by username once.
+                if user is None:
+                    if named is None or named.gid is not None:
+                        continue
+
+                    user = named
+                    user.gid = ref.id
+
+                    changed.append(user)
+                elif named is not None and named.pk in keep:
+                    # Target users and seeders keep their row so fold the other one into it. If both are target users, leave them alone.
+                    if User.merge(user, named):
+                        user = named
+                        user.gid = ref.id
+
+                        changed.append(user)
+                elif user.username != ref.login:
+                    # The account was renamed.
+                    user.username = ref.login
+
+                    changed.append(user)
+
+                matched[ref.id] = user
+
+            # Move users out of the way whose username now belongs to another account. They keep a placeholder ("#" + ID) until they show up under their new name.
+            stale = [user.pk for login, user in by_name.items() if user.pk not in keep and (logins[login].id not in matched or matched[logins[login].id].pk != user.pk)]
+
+            if len(stale) > 0:
+                User.objects.filter(pk__in = stale).update(username = Concat(Value("#"), Cast("pk", models.CharField())))
+                User.objects.filter(pk__in = stale).exclude(pk__in = [user.pk for user in matched.values()]).update(needs_parsing = False)
+
+            if len(changed) > 0:
+                User.objects.bulk_update(changed, ["gid", "username"])
+
+            created = [User(gid = ref.id, username = ref.login, **defaults) for ref in refs if ref.id not in matched]
+
+            # Users inserted by another worker in the meantime are skipped by the unique constraints.
+            if len(created) > 0:
+                User.objects.bulk_create(created, ignore_conflicts = True)
+
+                for user in User.objects.filter(gid__in = [user.gid for user in created]):
+                    matched[user.gid] = user
+
+        return [matched[ref.id] for ref in refs if ref.id in matched], created
+
+    def is_placeholder(self):
+        # Users whose username was taken by another account are addressed by "#" + ID until they show up under their new name. GitHub can't be sent anything about them meanwhile.
+        return self.username.startswith("#")
+
+    def merge(user, into):
+        # Moves the follows, jobs and seeders of a user onto another one and deletes it. Returns False if the user is a target user itself.
+        if Target_User.objects.filter(user = user).exists():
+            return False
+
+        for model in (Follower, Following):
+            model.objects.filter(user = user).exclude(target_user__in = model.objects.filter(user = into).values("target_user")).update(user = into)
+
+        # Pending jobs that are also pending for the other user are dropped.
+        pending = set(Job.objects.filter(user = into, status__in = ["queued", "running"]).values_list("kind", "target_user_id"))
+
+        jobs = [job.pk for job in Job.objects.filter(user = user) if job.status not in ["queued", "running"] or (job.kind, job.target_user_id) not in pending]
+
+        Job.objects.filter(pk__in = jobs).update(user = into)
+        Seeder.objects.filter(user = user).update(user = into)
+        User.objects.filter(parent = user.pk).update(parent = into.pk)
+
+        User.objects.filter(pk = user.pk).delete()
+
+        return True
 
     def save(self, *args, **kwargs):
         try:
@@ -92,98 +207,120 @@ class Target_User(models.Model):
     allow_follow = models.BooleanField(verbose_name = "Allow Following", help_text = "If true, this user will start following parsed users.", default = True)
     allow_unfollow = models.BooleanField(verbose_name = "Allow Unfollowing", help_text = "If true, the bot will unfollow users for this target user.", default = True)
 
-    async def follow_user(self, user):
+    async def follow_user(self, user, batch = None):
+        # Returns False if the request failed.
+
         # Check if we should follow.
         if not self.allow_follow:
-            return
+            return True
 
-        # Make connection GitHub's API.
-        if back_bone.parser.api is None:
-            back_bone.parser.api = ga.GH_API()
+        # Use our own GitHub API client.
+        api = back_bone.parser.get_api(self)
 
-        # Authenticate
-        back_bone.parser.api.authenticate(self.user.username, self.token)
+        while True:
+            res = None
 
-        res = None
+            # Send request.
+            try:
+                res = await api.send('PUT', '/user/following/' + user.username)
+            except Exception as e:
+                print("[ERR] Failed to follow GitHub user " + user.username + " for " + self.user.username + " (request failure).")
+                print(e)
 
-        # Send request.
-        try:
-            res = await back_bone.parser.api.send('PUT', '/user/following/' + user.username)
-        except Exception as e:
-            print("[ERR] Failed to follow GitHub user " + user.username + " for " + self.user.username + " (request failure).")
-            print(e)
+                await back_bone.parser.do_fail(api)
 
-            await back_bone.parser.do_fail()
+                return False
 
-            return
+            # Check status code.
+            if res[1] == 200 or res[1] == 204:
+                break
 
-        # Check status code.
-        if res[1] != 200 and res[1] != 204:
-            await back_bone.parser.do_fail()
+            # Wait out rate limits instead of failing.
+            if await back_bone.parser.wait_rate_limit(api, res):
+                continue
 
-            return
+            await back_bone.parser.do_fail(api)
+
+            return False
+
+        misc.users_followed.inc(target_user = self.pk)
 
         # Save to following.
-        await sync_to_async(Following.objects.create)(target_user = self, user = user)
+        await self.add_following(user, batch)
 
-        if int(await sync_to_async(Setting.get)(key = "verbose")) >= 1:
+        if registry.snapshot.verbose >= 1:
             print("[V] Following user " + user.username + " for " + self.user.username + ".")
 
-    @sync_to_async
-    def get_following(self, user):
-        res = None
+        return True
 
-        try:
-            res = list(Following.objects.filter(target_user = self, user = user))
-            res = res[0]
-        except Exception as e:
-            res = None
+    async def add_following(self, user, batch = None):
+        following = Following(target_user = self, user = user, time_added = back_bone.parser.clock.now())
+
+        # Queue the insert if the caller writes in batches.
+        if batch is not None:
+            batch.add_following(following)
+        else:
+            with misc.span("save"):
+                await sync_to_async(Following.objects.bulk_create)([following], ignore_conflicts = True)
 
-        return res
+        # Keep the parser's follow-state index up to date.
+        back_bone.parser.note_following(self, user)
+
+    @sync_to_async
+    def set_purged(self, user):
+        # Mark the user as purged with one update instead of retrieving and saving the row.
+        Following.objects.filter(target_user = self, user = user).update(purged = True)
+
+    async def unfollow_user(self, user, batch = None):
+        # Returns False if the request failed.
 
-    async def unfollow_user(self, user):
         # Check if we should unfollow.
         if not self.allow_unfollow:
-            return
+            return True
 
-        # Make connection GitHub's API.
-        if back_bone.parser.api is None:
-            back_bone.parser.api = ga.GH_API()
+        # Use our own GitHub API client.
+        api = back_bone.parser.get_api(self)
 
-        # Authenticate
-        back_bone.parser.api.authenticate(self.user.username, self.token)
+        while True:
+            res = None
 
-        res = None
+            # Send request.
+            try:
+                res = await api.send('DELETE', '/user/following/' + user.username)
+            except Exception as e:
+                print("[ERR] Failed to unfollow GitHub user " + user.username + " for " + self.user.username + " (request failure).")
+                print(e)
 
-        # Send request.
-        try:
-            res = await back_bone.parser.api.send('DELETE', '/user/following/' + user.username)
-        except Exception as e:
-            print("[ERR] Failed to unfollow GitHub user " + user.username + " for " + self.user.username + " (request failure).")
-            print(e)
+                await back_bone.parser.do_fail(api)
 
-            await back_bone.parser.do_fail()
+                return False
 
-            return
+            # Check status code.
+            if res[1] == 200 or res[1] == 204:
+                break
 
-        # Check status code.
-        if res[1] != 200 and res[1] != 204:
-            await back_bone.parser.do_fail()
+            # Wait out rate limits instead of failing.
+            if await back_bone.parser.wait_rate_limit(api, res):
+                continue
 
-            return
+            await back_bone.parser.do_fail(api)
 
-        following = await self.get_following(user)
+            return False
 
-        # Set user as purged.
-        if following is not None:
-            following.purged = True
+        misc.users_unfollowed.inc(target_user = self.pk)
 
-            # Save.
-            await sync_to_async(following.save)()
+        # Set user as purged.
+        if batch is not None:
+            batch.set_purged(self, user)
+        else:
+            with misc.span("save"):
+                await self.set_purged(user)
 
-        if int(await sync_to_async(Setting.get)(key = "verbose")) >= 2:
+        if registry.snapshot.verbose >= 2:
             print("[VV] Unfollowing user " + user.username + " from " + self.user.username + ".")
 
+        return True
+
     class Meta:
         verbose_name = "Target User"
 
@@ -209,13 +346,18 @@ class Following(models.Model):
     user = models.ForeignKey(User, on_delete = models.CASCADE)
     purged = models.BooleanField(editable = False, default = False)
 
-    time_added = models.DateTimeField(editable = False, auto_now_add = True)
+    # Set by the parser's clock when following.
+    time_added = models.DateTimeField(editable = False, default = timezone.now)
 
     class Meta:
         constraints = [
             models.UniqueConstraint(fields = ['target_user', 'user'], name="following-target-user")
         ]
 
+        indexes = [
+            models.Index(fields = ['target_user', 'purged', 'time_added'], name = "following-purge-queue")
+        ]
+
     def __str__(self):
         return self.user.username
 
@@ -235,4 +377,85 @@ class Seeder(models.Model):
             return
 
     def __str__(self):
-        return self.user.username
\ No newline at end of file
+        return self.user.username
+
+class Response_Cache(models.Model):
+    credential = models.CharField(editable = False, max_length = 64)
+    url = models.CharField(editable = False, max_length = 255)
+
+    etag = models.CharField(editable = False, max_length = 255, blank = True, default = "")
+    last_modified = models.CharField(editable = False, max_length = 64, blank = True, default = "")
+    body = models.TextField(editable = False)
+
+    time_updated = models.DateTimeField(editable = False, auto_now = True)
+
+    class Meta:
+        verbose_name = "Response Cache"
+
+        constraints = [
+            models.UniqueConstraint(fields = ['credential', 'url'], name = "response-cache-key")
+        ]
+
+    def __str__(self):
+        return self.url
+class Job(models.Model):
+    KINDS = [
+        ("follow", "Follow"),
+        ("unfollow", "Unfollow"),
+        ("seed_page", "Seed Page")
+    ]
+
+    STATUSES = [
+        ("queued", "Queued"),
+        ("running", "Running"),
+        ("done", "Done"),
+        ("failed", "Failed")
+    ]
+
+    kind = models.CharField(editable = False, max_length = 16, choices = KINDS)
+
+    # The target user doing the (un)following (not set for seeding) and the user being (un)followed or seeded from.
+    target_user = models.ForeignKey(Target_User, editable = False, on_delete = models.CASCADE, null = True)
+    user = models.ForeignKey(User, editable = False, on_delete = models.CASCADE)
+
+    status = models.CharField(editable = False, max_length = 16, choices = STATUSES, default = "queued")
+
+    # Running jobs whose lease expired may be claimed again. Queued jobs aren't claimed before it (retry backoff).
+    lease_until = models.DateTimeField(editable = False, null = True)
+    attempts = models.IntegerField(editable = False, default = 0)
+    owner = models.CharField(editable = False, max_length = 128, blank = True, default = "")
+
+    time_added = models.DateTimeField(editable = False, default = timezone.now)
+
+    class Meta:
+        constraints = [
+            # Only one pending job for the same work.
+            models.UniqueConstraint(fields = ['kind', 'target_user', 'user'], condition = models.Q(status__in = ["queued", "running"], target_user__isnull = False), name = "job-pending"),
+            models.UniqueConstraint(fields = ['kind', 'user'], condition = models.Q(status__in = ["queued", "running"], target_user__isnull = True), name = "job-pending-seed")
+        ]
+
+        indexes = [
+            models.Index(fields = ['status', 'kind', 'lease_until'], name = "job-claim-queue")
+        ]
+
+    def __str__(self):
+        return self.kind + " " + self.user.username
+
+class Lease(models.Model):
+    # A lock held by one process at a time (e.g. the active parser) until it stops renewing it.
+    name = models.CharField(editable = False, max_length = 64, unique = True)
+    owner = models.CharField(editable = False, max_length = 128, blank = True, default = "")
+
+    lease_until = models.DateTimeField(editable = False, null = True)
+
+    def __str__(self):
+        return self.name
+
+class Worker(models.Model):
+    # A parser process that's alive as long as it keeps sending heartbeats. Users are split into shards between live workers.
+    name = models.CharField(editable = False, max_length = 128, unique = True)
+
+    heartbeat = models.DateTimeField(editable = False)
+
+    def __str__(self):
+        return self.name
@@ -0,0 +1,81 @@
+import dataclasses
+
+import misc
+
+@dataclasses.dataclass(frozen = True)
+class Settings_Snapshot():
+    enabled: bool = False
+    max_scan_users: int = 10
+    wait_time_follow_min: int = 10
+    wait_time_follow_max: int = 30
+    wait_time_list_min: int = 5
+    wait_time_list_max: int = 30
+    scan_time_min: int = 5
+    scan_time_max: int = 60
+    verbose: int = 1
+    user_agent: str = "GitHub-Follower"
+    seed: bool = True
+    seed_min_free: int = 64
+    max_api_fails: int = 5
+    lockout_wait_min: int = 1
+    lockout_wait_max: int = 10
+    seed_max_pages: int = 5
+    max_sync_workers: int = 4
+    api_transport: str = "rest"
+
+class Settings_Registry():
+    def __init__(self):
+        # Start with defaults until the settings table is loaded.
+        self.snapshot = Settings_Snapshot()
+
+        self.types = {}
+
+        for field in dataclasses.fields(Settings_Snapshot):
+            self.types[field.name] = field.type
+
+    def convert(self, key, val):
+        ftype = self.types[key]
+
+        if ftype is bool:
+            return bool(int(val))
+        elif ftype is int:
+            return int(val)
+
+        return str(val)
+
+    @misc.traced("settings.load")
+    def load(self):
+        import gf.models as mdl
+
+        vals = {}
+
+        # Retrieve all settings in one query.
+        for key, val in mdl.Setting.objects.values_list("key", "val"):
+            # Ignore unknown keys.
+            if key not in self.types:
+                continue
+
+            try:
+                vals[key] = self.convert(key, val)
+            except (TypeError, ValueError) as e:
+                print("[ERR] Invalid value for setting " + key + " (" + str(val) + "). Using default.")
+                print(e)
+
+        # Replace the snapshot as a whole so readers never see a partial update.
+        self.snapshot = Settings_Snapshot(**vals)
+
+        return self.snapshot
+
+    def create_defaults(self):
+        import gf.models as mdl
+
+        # Add missing settings with their default values so they show up in the admin center.
+        for field in dataclasses.fields(Settings_Snapshot):
+            val = field.default
+
+            if isinstance(val, bool):
+                val = int(val)
+
+            mdl.Setting.create(field.name, str(val), False)
+
+registry = Settings_Registry()
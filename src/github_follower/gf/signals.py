@@ -0,0 +1,15 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Setting
+from .registry import registry
+
+@receiver(post_save, sender = Setting)
+@receiver(post_delete, sender = Setting)
+def reload_settings(sender, **kwargs):
+    # Replace the settings snapshot whenever a setting is changed.
+    registry.load()
+
+def create_default_settings(sender, **kwargs):
+    # Connected to post_migrate for this app only.
+    registry.create_defaults()
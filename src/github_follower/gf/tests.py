@@ -1,3 +1,555 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import time
 
-# Create your tests here.
+from django.contrib.auth.models import User as Auth_User
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from asgiref.sync import async_to_sync, sync_to_async
+
+import back_bone
+import github_api as ga
+import github_api.graphql as gql
+import gf.models as mdl
+from github_api.decode import User_Ref
+from github_api.fake import Fake_GitHub
+
+class User_Match_Tests(TestCase):
+    def names(self):
+        return dict(mdl.User.objects.filter(gid__isnull = False).values_list("gid", "username"))
+
+    def test_backfill(self):
+        # Users added before GitHub IDs were stored get theirs by username.
+        user = mdl.User.objects.create(username = "alice")
+
+        users, created = mdl.User.match([User_Ref(1, "alice"), User_Ref(2, "bob")], needs_parsing = False)
+
+        self.assertEqual(users[0].pk, user.pk)
+        self.assertEqual([u.username for u in created], ["bob"])
+        self.assertEqual(self.names(), {1: "alice", 2: "bob"})
+        self.assertFalse(mdl.User.objects.get(gid = 2).needs_parsing)
+
+    def test_rename(self):
+        mdl.User.match([User_Ref(1, "alice")])
+
+        # The account was renamed and another account took the old name.
+        users, created = mdl.User.match([User_Ref(1, "alicia"), User_Ref(3, "alice")])
+
+        self.assertEqual([u.username for u in users], ["alicia", "alice"])
+        self.assertEqual(self.names(), {1: "alicia", 3: "alice"})
+
+    def test_swap(self):
+        mdl.User.match([User_Ref(1, "bob"), User_Ref(2, "carol")])
+
+        users, created = mdl.User.match([User_Ref(1, "carol"), User_Ref(2, "bob")])
+
+        self.assertEqual(created, [])
+        self.assertEqual(self.names(), {1: "carol", 2: "bob"})
+
+    def test_placeholder(self):
+        mdl.User.match([User_Ref(1, "alice")])
+
+        # The name now belongs to another account and the old account hasn't shown up under its new name yet.
+        mdl.User.match([User_Ref(2, "alice")])
+
+        old = mdl.User.objects.get(gid = 1)
+
+        self.assertEqual(old.username, "#" + str(old.pk))
+        self.assertFalse(old.needs_parsing)
+
+        mdl.User.match([User_Ref(1, "ally")])
+
+        self.assertEqual(self.names(), {1: "ally", 2: "alice"})
+
+    def test_keep_target_user(self):
+        # Seen under an old name first, then renamed to the name a target user was added with through the admin center.
+        mdl.User.match([User_Ref(1, "old")])
+
+        seen = mdl.User.objects.get(gid = 1)
+        user = mdl.User.objects.create(username = "target")
+        tuser = mdl.Target_User.objects.create(user = user, cleanup_days = 0, token = "token")
+
+        other = mdl.User.objects.create(username = "other")
+        other_tuser = mdl.Target_User.objects.create(user = other, cleanup_days = 0, token = "token")
+
+        mdl.Following.objects.create(target_user = other_tuser, user = seen)
+
+        users, created = mdl.User.match([User_Ref(1, "target")])
+
+        # The target user's row gets the ID and the other row is folded into it.
+        self.assertEqual(users[0].pk, user.pk)
+        self.assertEqual(created, [])
+        self.assertEqual(mdl.User.objects.get(pk = user.pk).gid, 1)
+        self.assertFalse(mdl.User.objects.filter(pk = seen.pk).exists())
+        self.assertTrue(mdl.Target_User.objects.filter(pk = tuser.pk).exists())
+        self.assertTrue(mdl.Following.objects.filter(target_user = other_tuser, user = user).exists())
+
+    def test_keep_seeder(self):
+        mdl.User.match([User_Ref(1, "seed")])
+
+        seen = mdl.User.objects.get(gid = 1)
+        user = mdl.User.objects.create(username = "seeder")
+        seeder = mdl.Seeder.objects.create(user = user)
+
+        mdl.User.match([User_Ref(1, "seeder")])
+
+        self.assertEqual(mdl.Seeder.objects.get(pk = seeder.pk).user.gid, 1)
+        self.assertFalse(mdl.User.objects.filter(pk = seen.pk).exists())
+
+class Fake_GitHub_Case(TestCase):
+    # Runs a fake GitHub API for the test case's API clients.
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+
+        cls.fake = Fake_GitHub(users = 300, followers = 250)
+        cls.fake.start_thread()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.fake.stop_thread()
+
+        super().tearDownClass()
+
+    def get_api(self, login = "user0"):
+        api = ga.GH_API()
+        api.endpoint = self.fake.url
+        api.authenticate(login, "token")
+
+        return api
+
+class Page_Tests(Fake_GitHub_Case):
+    def test_next_page(self):
+        link = '<https://api.github.com/user/followers?per_page=100&page=3>; rel="next", <https://api.github.com/user/followers?per_page=100&page=9>; rel="last"'
+
+        self.assertEqual(ga.get_next_page({"Link": link}), 3)
+        self.assertIsNone(ga.get_next_page({"Link": '<https://api.github.com/user/followers?page=1>; rel="prev"'}))
+        self.assertIsNone(ga.get_next_page({"Link": '<https://api.github.com/user/followers?page=x>; rel="next"'}))
+        self.assertIsNone(ga.get_next_page({}))
+
+    async def test_iter_pages(self):
+        api = self.get_api()
+
+        pages = []
+        ids = []
+
+        try:
+            async for data, page, next_page in ga.iter_pages(api, "/users/user1/followers", decode = ga.decode_users):
+                pages.append((page, next_page))
+                ids.extend(ref.id for ref in data)
+
+            # Stop at the last page even if there are more.
+            limited = [page async for data, page, next_page in ga.iter_pages(api, "/users/user1/followers", last_page = 2)]
+        finally:
+            await api.close()
+
+        self.assertEqual(pages, [(1, 2), (2, 3), (3, None)])
+        self.assertEqual(ids, [self.fake.get_user(login)["id"] for login in self.fake.get_followers("user1")])
+        self.assertEqual(limited, [1, 2])
+
+    async def test_cached_pages(self):
+        api = self.get_api()
+
+        # Record the status of each response.
+        statuses = []
+        send = api.send
+
+        async def record(*args, **kwargs):
+            res = await send(*args, **kwargs)
+
+            statuses.append(res[1])
+
+            return res
+
+        api.send = record
+
+        try:
+            for _ in range(2):
+                pages = [data async for data, page, next_page in ga.iter_pages(api, "/users/user2/followers", cached_pages = lambda page: page == 1)]
+        finally:
+            await api.close()
+
+        # Only the first page is cached and it's answered from the cache the second time.
+        self.assertEqual(statuses, [200, 200, 200, 304, 200, 200])
+        self.assertEqual([len(data) for data in pages], [100, 100, 50])
+        self.assertEqual(await sync_to_async(list)(mdl.Response_Cache.objects.values_list("url", flat = True)), ["/users/user2/followers?per_page=100&page=1"])
+
+class GraphQL_Tests(Fake_GitHub_Case):
+    async def test_iter_followers(self):
+        api = self.get_api()
+
+        pages = []
+        logins = []
+
+        try:
+            async for users, page, next_page, after in gql.iter_followers(api, "user1", per_page = 100):
+                pages.append((page, next_page, after))
+                logins.extend(ref.login for ref in users)
+
+            viewer = [ref.login async for users, page, next_page, after in gql.iter_followers(api, per_page = 100) for ref in users]
+
+            with self.assertRaises(ga.Page_Error):
+                async for item in gql.iter_followers(api, "nobody"):
+                    pass
+        finally:
+            await api.close()
+
+        self.assertEqual(pages, [(1, 2, "100"), (2, 3, "200"), (3, None, "200")])
+        self.assertEqual(logins, self.fake.get_followers("user1"))
+        self.assertEqual(viewer, self.fake.get_followers("user0"))
+
+    async def test_lookup_users(self):
+        api = self.get_api()
+
+        self.fake.following["user0"] = {"user2"}
+
+        logins = ["user" + str(i) for i in range(150)] + ["nobody", "user2"]
+
+        try:
+            users = await gql.lookup_users(api, logins)
+        finally:
+            await api.close()
+
+        # Duplicates are looked up once, in batches of LOOKUP_BATCH.
+        self.assertEqual(len(users), 151)
+        self.assertIsNone(users["nobody"])
+        self.assertEqual(users["user2"]["id"], 3)
+        self.assertTrue(users["user2"]["viewerIsFollowing"])
+        self.assertFalse(users["user3"]["viewerIsFollowing"])
+        self.assertEqual(users["user1"]["isFollowingViewer"], "user0" in self.fake.get_followers("user1"))
+
+class Follow_Targets_Tests(TestCase):
+    async def test_relations(self):
+        tuser = await sync_to_async(mdl.Target_User.objects.create)(user = await sync_to_async(mdl.User.objects.create)(username = "user0", gid = 1), cleanup_days = 0, token = "token")
+        users = [await sync_to_async(mdl.User.objects.create)(username = login) for login in ["followed", "follower", "other"]]
+
+        back_bone.parser.relations[tuser.pk] = {"followed": {"viewerIsFollowing": True, "isFollowingViewer": False}, "follower": {"viewerIsFollowing": False, "isFollowingViewer": True}, "other": {"viewerIsFollowing": False, "isFollowingViewer": False}}
+
+        batch = back_bone.DB_Batch()
+
+        try:
+            for user in users:
+                await back_bone.parser.loop_and_follow_targets(user, [tuser], batch)
+        finally:
+            back_bone.parser.relations.pop(tuser.pk)
+            back_bone.parser.indexes.pop(tuser.pk, None)
+
+        # Only users without a relationship with the target user are queued for following.
+        self.assertEqual([job.user.username for job in batch.jobs], ["other"])
+        self.assertEqual([following.user.username for following in batch.following], ["followed"])
+
+class Parse_Batch_Tests(TestCase):
+    def seed_jobs(self):
+        return mdl.Job.objects.filter(kind = "seed_page", status = "queued").count()
+
+    async def parse_batch(self):
+        await back_bone.parser.parse_batch()
+
+        return await sync_to_async(self.seed_jobs)()
+
+    async def test_seed_jobs(self):
+        users = [await sync_to_async(mdl.User.objects.create)(username = "user" + str(i), gid = i + 1) for i in range(5)]
+
+        # This user's followers were gone through up to the max pages.
+        users[4].cur_page = back_bone.parser.conf.seed_max_pages + 1
+
+        await sync_to_async(users[4].save)()
+
+        self.assertEqual(await self.parse_batch(), 4)
+
+        # The seed worker ran them.
+        await sync_to_async(mdl.Job.objects.update)(status = "done")
+        await sync_to_async(mdl.User.objects.update)(last_seeded = timezone.now())
+
+        self.assertEqual(await self.parse_batch(), 0)
+
+        # Seeded from again after the reseed time.
+        await sync_to_async(mdl.User.objects.filter(pk__in = [users[0].pk, users[4].pk]).update)(last_seeded = timezone.now() - datetime.timedelta(seconds = back_bone.RESEED_TIME + 1))
+
+        self.assertEqual(await self.parse_batch(), 1)
+
+class Unfollow_Job_Tests(Fake_GitHub_Case):
+    async def run_job(self, job):
+        batch = back_bone.DB_Batch()
+
+        ok = await back_bone.parser.run_job(job, batch)
+
+        await batch.flush()
+
+        return ok
+
+    async def test_renamed(self):
+        tuser = await sync_to_async(mdl.Target_User.objects.create)(user = await sync_to_async(mdl.User.objects.create)(username = "user0", gid = 1), cleanup_days = 1, token = "token")
+        user = await sync_to_async(mdl.User.objects.create)(username = "user5", gid = 6)
+
+        # The purge loop marks users as purged when it queues unfollowing them.
+        await sync_to_async(mdl.Following.objects.create)(target_user = tuser, user = user, time_added = timezone.now() - datetime.timedelta(days = 2), purged = True)
+
+        self.fake.following["user0"] = {"user5"}
+
+        api = back_bone.parser.get_api(tuser)
+        api.endpoint = self.fake.url
+
+        # Another account takes the username before the job runs.
+        await sync_to_async(mdl.User.match)([User_Ref(1000, "user5")])
+
+        job = mdl.Job(kind = "unfollow", target_user = tuser, user = await sync_to_async(mdl.User.objects.get)(pk = user.pk))
+
+        try:
+            self.assertTrue(await self.run_job(job))
+
+            # Nothing is sent and the purge loop leaves the user until we know their new name.
+            self.assertFalse(any(route.startswith("DELETE") for route in self.fake.stats))
+            self.assertTrue(await sync_to_async(mdl.Following.objects.filter(user = user, purged = False).exists)())
+            self.assertEqual(await back_bone.parser.get_expired_following(tuser, time.time()), [])
+
+            # The account shows up under its new name.
+            self.fake.following["user0"] = {"renamed"}
+
+            await sync_to_async(mdl.User.match)([User_Ref(6, "renamed")])
+
+            expired = await back_bone.parser.get_expired_following(tuser, time.time())
+
+            self.assertEqual([following.user.username for following in expired], ["renamed"])
+
+            # Unfollowed without the follow wait of the job workers.
+            self.assertTrue(await tuser.unfollow_user(expired[0].user))
+        finally:
+            await api.close()
+
+            back_bone.parser.clients.clients.pop(tuser.pk)
+
+        self.assertEqual(self.fake.following["user0"], set())
+        self.assertEqual(self.fake.stats.get("DELETE /user/following/:user"), 1)
+        self.assertTrue(await sync_to_async(mdl.Following.objects.filter(user = user, purged = True).exists)())
+
+class Job_Queue_Tests(TestCase):
+    def setUp(self):
+        self.now = timezone.now()
+        self.user = mdl.User.objects.create(username = "user")
+        self.job = mdl.Job.objects.create(kind = "seed_page", user = self.user)
+
+    def claim(self, queue, now, lease = 60):
+        return async_to_sync(queue.claim)(["seed_page"], 10, now, lease)
+
+    def test_claim(self):
+        a = back_bone.Job_Queue("a")
+        b = back_bone.Job_Queue("b")
+
+        jobs = self.claim(a, self.now)
+
+        self.assertEqual([(job.id, job.status, job.owner, job.attempts) for job in jobs], [(self.job.id, "running", "a", 1)])
+
+        # Leased jobs can't be claimed by anybody else until the lease runs out.
+        self.assertEqual(self.claim(b, self.now + datetime.timedelta(seconds = 30)), [])
+
+        jobs = self.claim(b, self.now + datetime.timedelta(seconds = 61))
+
+        self.assertEqual([(job.owner, job.attempts) for job in jobs], [("b", 2)])
+
+        # The old owner can't finish a job it lost.
+        a.finish([self.job], [], self.now)
+
+        self.assertEqual(mdl.Job.objects.get(pk = self.job.pk).status, "running")
+
+    def test_renew(self):
+        a = back_bone.Job_Queue("a")
+
+        jobs = self.claim(a, self.now)
+
+        async_to_sync(a.renew)(jobs, self.now + datetime.timedelta(seconds = 50), 60)
+
+        self.assertEqual(self.claim(back_bone.Job_Queue("b"), self.now + datetime.timedelta(seconds = 100)), [])
+
+    def test_retry(self):
+        a = back_bone.Job_Queue("a")
+
+        jobs = self.claim(a, self.now)
+
+        a.finish([], jobs, self.now)
+
+        # Failed jobs are queued again after a backoff.
+        self.assertEqual(self.claim(a, self.now), [])
+        self.assertEqual(len(self.claim(a, self.now + datetime.timedelta(seconds = back_bone.jobs.RETRY_TIME))), 1)
+
+    def test_release(self):
+        a = back_bone.Job_Queue("a")
+
+        jobs = self.claim(a, self.now)
+
+        a.release(jobs)
+
+        job = mdl.Job.objects.get(pk = self.job.pk)
+
+        self.assertEqual((job.status, job.attempts), ("queued", 0))
+
+class Leader_Lease_Tests(TestCase):
+    def acquire(self, lease, secs):
+        return async_to_sync(lease.acquire)(self.now + datetime.timedelta(seconds = secs))
+
+    def setUp(self):
+        self.now = timezone.now()
+
+    def test_acquire(self):
+        a = back_bone.Leader_Lease(owner = "a", ttl = 30)
+        b = back_bone.Leader_Lease(owner = "b", ttl = 30)
+
+        self.assertTrue(self.acquire(a, 0))
+        self.assertFalse(self.acquire(b, 10))
+
+        # Renewing moves the expiry forward.
+        self.assertTrue(self.acquire(a, 20))
+        self.assertFalse(self.acquire(b, 40))
+
+        # An expired lease is taken over.
+        self.assertTrue(self.acquire(b, 51))
+        self.assertFalse(self.acquire(a, 52))
+
+    def test_release(self):
+        a = back_bone.Leader_Lease(owner = "a", ttl = 30)
+        b = back_bone.Leader_Lease(owner = "b", ttl = 30)
+
+        self.assertTrue(self.acquire(a, 0))
+
+        async_to_sync(a.release)()
+
+        self.assertTrue(self.acquire(b, 1))
+
+    def test_db_time(self):
+        a = back_bone.Leader_Lease(owner = "a", ttl = 30)
+        b = back_bone.Leader_Lease(owner = "b", ttl = 30)
+
+        self.assertTrue(async_to_sync(a.acquire)())
+        self.assertFalse(async_to_sync(b.acquire)())
+        self.assertTrue(async_to_sync(a.acquire)())
+
+class Virtual_Clock_Tests(TestCase):
+    def test_run(self):
+        clock = back_bone.Virtual_Clock(start = 1000.0)
+
+        async def work():
+            # The clock doesn't move while executor calls run.
+            await asyncio.get_running_loop().run_in_executor(None, time.sleep, 0.05)
+
+            return clock.time()
+
+        async def main():
+            ret = await asyncio.gather(work(), clock.sleep(3600), asyncio.wait_for(asyncio.sleep(60), 120))
+
+            return ret[0], clock.time()
+
+        real = time.monotonic()
+
+        self.assertEqual(clock.run(main()), (1000.0, 4600.0))
+        self.assertLess(time.monotonic() - real, 5.0)
+
+class Rate_Budget_Tests(TestCase):
+    def setUp(self):
+        self.clock = back_bone.Virtual_Clock(start = 1000.0)
+        self.budget = ga.Rate_Budget(self.clock)
+
+    def test_reset(self):
+        self.budget.update(200, {"X-RateLimit-Limit": "5000", "X-RateLimit-Remaining": "1", "X-RateLimit-Reset": "1100"})
+
+        self.assertEqual(self.budget.wait_time(), 0.0)
+
+        self.budget.update(403, {"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": "1100"})
+
+        self.assertEqual(self.budget.wait_time(), 100.0)
+        self.assertTrue(self.budget.is_limited(403))
+        self.assertFalse(self.budget.is_limited(500))
+
+        self.clock.cur = 1100.0
+
+        self.assertEqual(self.budget.wait_time(), 0.0)
+
+    def test_retry_after(self):
+        self.budget.update(429, {"Retry-After": "30"})
+
+        self.assertEqual(self.budget.wait_time(), 30.0)
+
+        # Secondary rate limits without Retry-After wait a minute.
+        self.clock.cur = 1030.0
+
+        self.budget.update(429, {})
+
+        self.assertEqual(self.budget.wait_time(), 60.0)
+        self.assertTrue(self.budget.is_limited(429))
+
+    def test_resources(self):
+        api = ga.GH_API(self.clock)
+        api.authenticate("user0", "token")
+
+        self.assertEqual(ga.get_resource("/graphql"), "graphql")
+        self.assertEqual(ga.get_resource("/users/user1/followers?per_page=100&page=2"), "core")
+
+        # Using up the GraphQL rate limit doesn't hold back REST requests.
+        api.get_budget("graphql").update(200, {"X-RateLimit-Resource": "graphql", "X-RateLimit-Remaining": "0", "X-RateLimit-Reset": "1100"})
+
+        self.assertEqual(api.wait_time("graphql"), 100.0)
+        self.assertEqual(api.wait_time(), 0.0)
+
+    def test_invalid_headers(self):
+        self.budget.update(200, {"X-RateLimit-Remaining": "many"})
+
+        self.assertEqual(self.budget.wait_time(), 0.0)
+
+class Fake_GitHub_Tests(TestCase):
+    async def test_conditional_charge(self):
+        fake = Fake_GitHub(users = 300, followers = 250, rate_limit = 10)
+        fake.start_thread()
+
+        api = ga.GH_API()
+        api.endpoint = fake.url
+        api.authenticate("user0", "token")
+
+        # A stale ETag makes the conditional request of the second page miss.
+        await sync_to_async(mdl.Response_Cache.objects.create)(credential = api.get_credential(), url = "/users/user1/followers?per_page=100&page=2", etag = '"stale"', body = "[]")
+
+        try:
+            for _ in range(2):
+                [page async for data, page, next_page in ga.iter_pages(api, "/users/user1/followers", last_page = 2, cached_pages = lambda page: True)]
+        finally:
+            await api.close()
+
+            fake.stop_thread()
+
+        # Both full responses of the first pass are charged and the 304s of the second pass are free.
+        self.assertEqual(fake.budgets[(api.headers["Authorization"], "core")][0], 8)
+
+class Metrics_View_Tests(TestCase):
+    @override_settings(METRICS_TOKEN = "")
+    def test_no_token(self):
+        self.assertEqual(self.client.get("/metrics").status_code, 403)
+        self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION = "Bearer ").status_code, 403)
+
+        self.client.force_login(Auth_User.objects.create(username = "staff", is_staff = True))
+
+        self.assertEqual(self.client.get("/metrics").status_code, 200)
+
+    @override_settings(METRICS_TOKEN = "secret")
+    def test_token(self):
+        self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION = "Bearer wrong").status_code, 403)
+        self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION = "Bearer secret").status_code, 200)
+
+    async def test_resource_budgets(self):
+        fake = Fake_GitHub(users = 300, followers = 250, rate_limit = 10)
+        fake.start_thread()
+
+        api = ga.GH_API()
+        api.endpoint = fake.url
+        api.authenticate("user0", "token")
+
+        try:
+            await gql.lookup_users(api, ["user1"])
+            await api.send("GET", "/users/user1/followers")
+            await api.send("GET", "/users/user2/followers")
+        finally:
+            await api.close()
+
+            fake.stop_thread()
+
+        # Each response is counted against the rate limit GitHub says it used.
+        self.assertEqual(api.get_budget("graphql").remaining, 9)
+        self.assertEqual(api.get_budget().remaining, 8)
@@ -1,3 +1,20 @@
-from django.shortcuts import render
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
 
-# Create your views here.
+import back_bone
+import misc
+
+def metrics(request):
+    # The parser runs in its own process (run_parser) so this only has the parse and job queue backlog read from the DB. Parser and GitHub API client counters are only served by run_parser --metrics-port.
+    # Only staff users and scrapers with the metrics token may see this.
+    if not (request.user.is_active and request.user.is_staff) and not misc.check_token(request.headers.get("Authorization", ""), getattr(settings, "METRICS_TOKEN", "")):
+        return HttpResponseForbidden()
+
+    # Values that aren't updated as they happen are refreshed on each scrape.
+    try:
+        back_bone.parser.update_queue_metrics()
+    except Exception as e:
+        print("[ERR] Failed to update parse queue metrics.")
+        print(e)
+
+    return HttpResponse(misc.stats.render(), content_type = "text/plain; version=0.0.4; charset=utf-8")
@@ -1,4 +1,8 @@
 __name__ = "GitHub API"
 __version__ = "1.0.0"
 
-from .api import *
\ No newline at end of file
+from .api import *
+from .budget import *
+from .registry import *
+from .pages import *
+from .decode import *
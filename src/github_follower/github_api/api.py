@@ -1,14 +1,52 @@
 import aiohttp
 import asyncio
 import base64
+import hashlib
+import re
+import time
+
+from asgiref.sync import sync_to_async
+
+from django.conf import settings
+
+import misc
+
+from .budget import Rate_Budget
+
+def get_endpoint(url):
+    # Collapse user names and query strings so metric labels stay bounded.
+    path = url.split("?")[0]
+
+    path = re.sub(r"/following/[^/]+", "/following/:user", path)
+
+    return re.sub(r"/users/[^/]+", "/users/:user", path)
+
+def get_resource(url):
+    # GitHub keeps separate rate limits for GraphQL and the REST API (core).
+    if url.split("?")[0] == "/graphql":
+        return "graphql"
+
+    return "core"
 
 class GH_API():
-    def __init__(self):
-        import gf.models as mdl
+    def __init__(self, clock = None):
+        from gf.registry import registry
         self.conn = None
+
+        # Clock used for rate limit budgets.
+        self.clock = time if clock is None else clock
+
+        # Requests being sent right now.
+        self.pending = 0
         self.headers = {}
 
-        self.endpoint = 'https://api.github.com'
+        self.endpoint = getattr(settings, "GH_API_ENDPOINT", 'https://api.github.com')
+
+        # Connection pool settings.
+        self.conn_limit = getattr(settings, "GH_API_CONN_LIMIT", 10)
+        self.dns_ttl = getattr(settings, "GH_API_DNS_TTL", 300)
+        self.connect_timeout = getattr(settings, "GH_API_CONNECT_TIMEOUT", 10)
+        self.read_timeout = getattr(settings, "GH_API_READ_TIMEOUT", 30)
 
         self.method = "GET"
         self.url = "/"
@@ -17,10 +55,13 @@ class GH_API():
         self.response_code = 0
         self.fails = 0
 
+        # Rate limit budget of each credential and resource.
+        self.budgets = {}
+
         # Default user agent.
-        user_agent = mdl.Setting.get("user_agent")
+        user_agent = registry.snapshot.user_agent
 
-        if user_agent is None:
+        if not user_agent:
             user_agent = "GitHub-Follower"
 
         self.add_header("User-Agent", user_agent)
@@ -37,50 +78,158 @@ class GH_API():
 
         self.add_header("Authorization", "Basic " + r.decode('ascii'))
 
-    async def send(self, method = "GET", url = "/", headers = {}):
-        # Make connection.
-        conn = aiohttp.ClientSession()
+    def get_conn(self):
+        # The session is created on first use so it binds to the running event loop and is then reused (keep-alive) for every request.
+        if self.conn is None or self.conn.closed:
+            connector = aiohttp.TCPConnector(limit = self.conn_limit, use_dns_cache = True, ttl_dns_cache = self.dns_ttl)
+            timeout = aiohttp.ClientTimeout(sock_connect = self.connect_timeout, sock_read = self.read_timeout)
+
+            self.conn = aiohttp.ClientSession(connector = connector, timeout = timeout)
+
+        return self.conn
+
+    async def close(self):
+        if self.conn is None:
+            return
+
+        # Close pooled connection.
+        try:
+            await self.conn.close()
+        except Exception as e:
+            print("[ERR] HTTP close error.")
+            print(e)
+
+        self.conn = None
+
+    def get_credential(self):
+        # Hash the authorization header so cache entries are kept per credential without storing tokens.
+        auth = self.headers.get("Authorization", "")
+
+        return hashlib.sha256(bytes(auth, encoding='utf8')).hexdigest()
+
+    def get_budget(self, resource = "core"):
+        key = (self.get_credential(), resource)
+
+        if key not in self.budgets:
+            self.budgets[key] = Rate_Budget(self.clock)
+
+        return self.budgets[key]
+
+    def wait_time(self, resource = "core"):
+        # Seconds to wait before the current credential may send another request to the resource.
+        return self.get_budget(resource).wait_time()
+
+    @misc.traced("api.cache")
+    @sync_to_async
+    @misc.traced("db")
+    def get_cache(self, credential, url):
+        import gf.models as mdl
+
+        return mdl.Response_Cache.objects.filter(credential = credential, url = url).first()
+
+    @misc.traced("api.cache")
+    @sync_to_async
+    @misc.traced("db")
+    def save_cache(self, credential, url, etag, last_modified, body):
+        import gf.models as mdl
+
+        mdl.Response_Cache.objects.update_or_create(credential = credential, url = url, defaults = {"etag": etag, "last_modified": last_modified, "body": body})
+
+    @misc.traced("api.send")
+    async def send(self, method = "GET", url = "/", headers = {}, data = None, cache = False):
+        conn = self.get_conn()
+
+        # Don't go over the rate limit of the resource the request uses. Report it like GitHub would and let the caller wait wait_time().
+        resource = get_resource(url)
+        budget = self.get_budget(resource)
+
+        if budget.wait_time() > 0:
+            return [None, 429, {"X-RateLimit-Resource": resource}]
 
         # Insert additional headers.
+        headers = dict(headers)
+
         if self.headers is not None:
             for k, v in self.headers.items():
                 headers[k] = v
 
+        # Make GET requests of pages we check again (cache set) conditional on what we have cached.
+        cache = cache and method == "GET"
+        cached = None
+        credential = None
+
+        if cache:
+            credential = self.get_credential()
+
+            try:
+                cached = await self.get_cache(credential, url)
+            except Exception as e:
+                print("[ERR] Failed to retrieve cached response for " + url + ".")
+                print(e)
+
+            if cached is not None:
+                if cached.etag:
+                    headers["If-None-Match"] = cached.etag
+
+                if cached.last_modified:
+                    headers["If-Modified-Since"] = cached.last_modified
+
         res = None
         status = None
-        failed = False
+        res_headers = {}
 
-        # Send request.
-        try:
-            if method == "POST":
-                res = await conn.post(self.endpoint + url, headers = headers)
-            elif method == "PUT":
-                res = await conn.put(self.endpoint + url, headers = headers)
-            elif method == "DELETE":
-                res = await conn.delete(self.endpoint + url, headers = headers)
-            else:
-                res = await conn.get(self.endpoint + url, headers = headers)
-        except Exception as e:
-            print(e)
+        # Credentials are labelled by a prefix of their hash.
+        label = self.get_credential()[:12]
+
+        misc.api_requests.inc(credential = label)
 
-            failed = True
+        start = time.perf_counter()
 
-        if not failed and res is not None:
-            status = res.status
-            res = await res.text()
+        # Send request and read the body so the connection is released back to the pool.
+        self.pending = self.pending + 1
 
-        # Close connection.
         try:
-            await conn.close()
+            with misc.span("api.request"):
+                async with conn.request(method, self.endpoint + url, headers = headers, data = data) as resp:
+                    status = resp.status
+                    res_headers = resp.headers
+                    res = await resp.text()
         except Exception as e:
-            print("[ERR] HTTP close error.")
             print(e)
 
-            return [None, 0]
+            res = None
+            status = None
         else:
-            # Set fails to 0 indicating we closed the connection.
-            if not failed and res is not None:
+            # GitHub tells us which rate limit the request counted against.
+            resource = res_headers.get("X-RateLimit-Resource", resource)
+            budget = self.get_budget(resource)
+
+            budget.update(status, res_headers)
+
+            # Set fails to 0 indicating the request succeeded.
+            if status < 400:
                 self.fails = 0
-        
-        # Return list (response, response code)
-        return [res, status]
\ No newline at end of file
+
+            if budget.remaining is not None:
+                misc.api_remaining.set(budget.remaining, credential = label, resource = resource)
+        finally:
+            self.pending = self.pending - 1
+
+        misc.api_latency.observe(time.perf_counter() - start, method = method, endpoint = get_endpoint(url), status = "error" if status is None else status)
+
+        if status == 304 and cached is not None:
+            # Not modified, use the cached body.
+            res = cached.body
+        elif status == 200 and cache:
+            etag = res_headers.get("ETag", "")
+            last_modified = res_headers.get("Last-Modified", "")
+
+            if etag or last_modified:
+                try:
+                    await self.save_cache(credential, url, etag, last_modified, res)
+                except Exception as e:
+                    print("[ERR] Failed to cache response for " + url + ".")
+                    print(e)
+
+        # Return list (response, response code, response headers)
+        return [res, status, res_headers]
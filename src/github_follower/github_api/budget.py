@@ -0,0 +1,51 @@
+import time
+
+class Rate_Budget():
+    def __init__(self, clock = None):
+        # Anything with a time() method (e.g. the parser's clock so simulations can skip through resets).
+        self.clock = time if clock is None else clock
+
+        self.limit = None
+        self.remaining = None
+        self.reset = 0.0
+
+        # Time we were told to wait until through Retry-After or a secondary rate limit.
+        self.retry_at = 0.0
+
+    def update(self, status, headers):
+        now = self.clock.time()
+
+        try:
+            if "X-RateLimit-Limit" in headers:
+                self.limit = int(headers["X-RateLimit-Limit"])
+
+            if "X-RateLimit-Remaining" in headers:
+                self.remaining = int(headers["X-RateLimit-Remaining"])
+
+            if "X-RateLimit-Reset" in headers:
+                self.reset = float(headers["X-RateLimit-Reset"])
+
+            if "Retry-After" in headers:
+                self.retry_at = now + float(headers["Retry-After"])
+            elif status == 429 and self.wait_time() <= 0:
+                # GitHub asks to wait at least a minute on secondary rate limits without Retry-After.
+                self.retry_at = now + 60.0
+        except ValueError as e:
+            print("[ERR] Failed to parse rate limit headers.")
+            print(e)
+
+    def wait_time(self):
+        now = self.clock.time()
+        wait = 0.0
+
+        if self.retry_at > now:
+            wait = self.retry_at - now
+
+        # Wait for the reset if the budget is used up.
+        if self.remaining is not None and self.remaining < 1 and self.reset > now:
+            wait = max(wait, self.reset - now)
+
+        return wait
+
+    def is_limited(self, status):
+        return (status == 403 or status == 429) and self.wait_time() > 0
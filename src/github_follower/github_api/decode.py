@@ -0,0 +1,66 @@
+import json
+
+# orjson is optional and used when it's installed. Its decode errors are json.JSONDecodeError too.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+class User_Ref():
+    # A user from a followers page with only the fields the parser reads. GitHub's user objects have about 20 fields.
+    __slots__ = ("id", "login")
+
+    def __init__(self, id, login):
+        self.id = id
+        self.login = login
+
+    def __repr__(self):
+        return "User_Ref(" + repr(self.id) + ", " + repr(self.login) + ")"
+
+def to_ref(obj, id_key = "id"):
+    # Returns None if the object isn't a user with an ID and login.
+    if not isinstance(obj, dict):
+        return None
+
+    uid = obj.get(id_key)
+    login = obj.get("login")
+
+    if uid is None or not isinstance(login, str):
+        return None
+
+    return User_Ref(uid, login)
+
+# Each object is turned into a User_Ref as soon as it's decoded so the full objects don't pile up for the whole page.
+ref_decoder = json.JSONDecoder(object_hook = to_ref)
+
+def loads(body):
+    if orjson is not None:
+        return orjson.loads(body)
+
+    return json.loads(body)
+
+def decode_users_json(body):
+    refs = ref_decoder.decode(body)
+
+    if not isinstance(refs, list):
+        return []
+
+    return [ref for ref in refs if ref is not None]
+
+def decode_users_orjson(body):
+    items = orjson.loads(body)
+
+    if not isinstance(items, list):
+        return []
+
+    return [ref for ref in (to_ref(item) for item in items) if ref is not None]
+
+def decode_users(body):
+    # Decodes a REST page of user objects into User_Refs. Objects without an ID or login are skipped.
+    if not body:
+        return []
+
+    if orjson is not None:
+        return decode_users_orjson(body)
+
+    return decode_users_json(body)
@@ -0,0 +1,299 @@
+import asyncio
+import base64
+import json
+import random
+import re
+import threading
+import time
+
+from aiohttp import web
+
+# A stand-in for GitHub's API used for benchmarks and local testing. Users of the synthetic social graph are named user<n> with ID n + 1.
+class Fake_GitHub():
+    def __init__(self, users = 10000, followers = 50, seed = 1, latency = 0.0, error_rate = 0.0, rate_limit = 0, rate_window = 3600, clock = None):
+        self.users = users
+        self.followers = followers
+        self.seed = seed
+
+        # Seconds added to every response.
+        self.latency = latency
+
+        # Chance of answering with a 500 error.
+        self.error_rate = error_rate
+
+        # Requests allowed per credential in each rate window (0 = unlimited).
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+
+        # Clock of the rate limit windows (anything with a time() method) so they can run on a simulation's virtual clock.
+        self.clock = time if clock is None else clock
+
+        self.random = random.Random(seed)
+
+        self.budgets = {}
+        self.following = {}
+        self.graph = {}
+
+        # Request count of each route.
+        self.stats = {}
+
+        self.runner = None
+        self.url = None
+
+        self.loop = None
+        self.thread = None
+
+    def get_user(self, login):
+        m = re.fullmatch(r"user(\d+)", login)
+
+        if m is None or int(m.group(1)) >= self.users:
+            return None
+
+        return {"id": int(m.group(1)) + 1, "login": login}
+
+    def get_followers(self, login):
+        if login not in self.graph:
+            # Followers are picked from the graph deterministically for each user.
+            rnd = random.Random(str(self.seed) + ":" + login)
+
+            cnt = min(self.followers, self.users)
+
+            self.graph[login] = ["user" + str(n) for n in sorted(rnd.sample(range(self.users), cnt))]
+
+        return self.graph[login]
+
+    def get_viewer(self, request):
+        auth = request.headers.get("Authorization", "")
+
+        if not auth.startswith("Basic "):
+            return None
+
+        try:
+            return base64.b64decode(auth[6:]).decode("utf8").split(":")[0]
+        except Exception:
+            return None
+
+    def to_json(self, login):
+        # Mimic the size of GitHub's user objects.
+        user = self.get_user(login) or {"id": 0, "login": login}
+
+        return {"login": login, "id": user["id"], "node_id": "U_" + login, "avatar_url": "https://avatars.example/u/" + str(user["id"]), "gravatar_id": "", "url": "https://api.example/users/" + login, "html_url": "https://example/" + login, "followers_url": "https://api.example/users/" + login + "/followers", "following_url": "https://api.example/users/" + login + "/following{/other_user}", "gists_url": "https://api.example/users/" + login + "/gists{/gist_id}", "starred_url": "https://api.example/users/" + login + "/starred{/owner}{/repo}", "subscriptions_url": "https://api.example/users/" + login + "/subscriptions", "organizations_url": "https://api.example/users/" + login + "/orgs", "repos_url": "https://api.example/users/" + login + "/repos", "events_url": "https://api.example/users/" + login + "/events{/privacy}", "received_events_url": "https://api.example/users/" + login + "/received_events", "type": "User", "site_admin": False}
+
+    def use_budget(self, request, headers):
+        # Returns False if the credential is over its rate limit.
+        if self.rate_limit < 1:
+            return True
+
+        # GraphQL has its own rate limit like on GitHub.
+        resource = "graphql" if request.path == "/graphql" else "core"
+
+        key = (request.headers.get("Authorization", request.remote), resource)
+        now = self.clock.time()
+
+        budget = self.budgets.get(key)
+
+        if budget is None or budget[1] <= now:
+            budget = [self.rate_limit, now + self.rate_window]
+
+            self.budgets[key] = budget
+
+        headers["X-RateLimit-Resource"] = resource
+        headers["X-RateLimit-Limit"] = str(self.rate_limit)
+        headers["X-RateLimit-Reset"] = str(int(budget[1]))
+
+        if budget[0] < 1:
+            headers["X-RateLimit-Remaining"] = "0"
+
+            return False
+
+        budget[0] = budget[0] - 1
+
+        headers["X-RateLimit-Remaining"] = str(budget[0])
+
+        return True
+
+    def limited_response(self, headers):
+        return web.Response(status = 403, headers = headers, text = '{"message": "API rate limit exceeded"}')
+
+    def list_response(self, request, logins, headers):
+        try:
+            per_page = min(int(request.query.get("per_page", 30)), 100)
+            page = max(int(request.query.get("page", 1)), 1)
+        except ValueError:
+            return web.Response(status = 422)
+
+        chunk = logins[(page - 1) * per_page:page * per_page]
+
+        if page * per_page < len(logins):
+            headers["Link"] = '<' + str(request.url.update_query(page = str(page + 1))) + '>; rel="next"'
+
+        headers["ETag"] = '"' + str(hash((tuple(chunk), page, per_page)) & 0xffffffff) + '"'
+
+        if request.headers.get("If-None-Match") == headers["ETag"]:
+            return web.Response(status = 304, headers = headers)
+
+        # Conditional requests that missed are charged like any other.
+        if request.headers.get("If-None-Match") is not None and not self.use_budget(request, headers):
+            return self.limited_response(headers)
+
+        return web.Response(text = json.dumps([self.to_json(login) for login in chunk]), content_type = "application/json", headers = headers)
+
+    def graphql_followers(self, logins, variables, viewer):
+        offset = int(variables.get("after") or 0)
+        first = min(int(variables.get("first") or 100), 100)
+
+        chunk = logins[offset:offset + first]
+
+        nodes = []
+
+        for login in chunk:
+            nodes.append({"databaseId": self.to_json(login)["id"], "login": login, "viewerIsFollowing": login in self.following.get(viewer, ()), "isFollowingViewer": viewer in self.get_followers(login)})
+
+        return {"nodes": nodes, "pageInfo": {"hasNextPage": offset + first < len(logins), "endCursor": str(offset + first)}}
+
+    def graphql(self, body, viewer):
+        query = body.get("query", "")
+        variables = body.get("variables") or {}
+
+        if "viewer {" in query:
+            return {"viewer": {"followers": self.graphql_followers(self.get_followers(viewer), variables, viewer)}}
+
+        if "$login" in query:
+            if self.get_user(variables.get("login", "")) is None:
+                return {"user": None}
+
+            return {"user": {"followers": self.graphql_followers(self.get_followers(variables["login"]), variables, viewer)}}
+
+        # Aliased user lookups.
+        data = {}
+
+        for alias, login in re.findall(r'(\w+): user\(login: "([^"]+)"\)', query):
+            user = self.get_user(login)
+
+            if user is None:
+                data[alias] = None
+
+                continue
+
+            data[alias] = {"databaseId": user["id"], "login": login, "viewerIsFollowing": login in self.following.get(viewer, ()), "isFollowingViewer": viewer in self.get_followers(login)}
+
+        return data
+
+    async def handle(self, request):
+        path = request.path
+        route = request.method + " " + re.sub(r"/users/[^/]+/", "/users/:user/", re.sub(r"/following/.+", "/following/:user", path))
+
+        self.stats[route] = self.stats.get(route, 0) + 1
+
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+
+        if self.error_rate > 0 and self.random.random() < self.error_rate:
+            return web.Response(status = 500)
+
+        headers = {}
+        viewer = self.get_viewer(request)
+
+        # Only conditional requests answered with 304 don't count against the rate limit like on GitHub. Lists charge conditional requests once they know the answer.
+        conditional = request.method == "GET" and request.headers.get("If-None-Match") is not None
+
+        if not conditional and not self.use_budget(request, headers):
+            return self.limited_response(headers)
+
+        if request.method == "GET" and path == "/user/followers":
+            if viewer is None:
+                return web.Response(status = 401, headers = headers)
+
+            return self.list_response(request, self.get_followers(viewer), headers)
+
+        m = re.fullmatch(r"/users/([^/]+)/followers", path)
+
+        if request.method == "GET" and m is not None:
+            if self.get_user(m.group(1)) is None:
+                return web.Response(status = 404, headers = headers)
+
+            return self.list_response(request, self.get_followers(m.group(1)), headers)
+
+        m = re.fullmatch(r"/user/following/([^/]+)", path)
+
+        if m is not None and request.method in ("PUT", "DELETE"):
+            if viewer is None:
+                return web.Response(status = 401, headers = headers)
+
+            following = self.following.setdefault(viewer, set())
+
+            if request.method == "PUT":
+                following.add(m.group(1))
+            else:
+                following.discard(m.group(1))
+
+            return web.Response(status = 204, headers = headers)
+
+        if request.method == "POST" and path == "/graphql":
+            try:
+                body = await request.json()
+            except json.JSONDecodeError:
+                return web.Response(status = 400, headers = headers)
+
+            return web.json_response({"data": self.graphql(body, viewer)}, headers = headers)
+
+        return web.Response(status = 404, headers = headers)
+
+    async def start(self, host = "127.0.0.1", port = 0):
+        app = web.Application()
+        app.router.add_route("*", "/{path:.*}", self.handle)
+
+        self.runner = web.AppRunner(app)
+
+        await self.runner.setup()
+
+        site = web.TCPSite(self.runner, host, port)
+
+        await site.start()
+
+        # Retrieve the port we were given.
+        port = self.runner.addresses[0][1]
+
+        self.url = "http://" + host + ":" + str(port)
+
+        return self.url
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+            self.runner = None
+
+    def start_thread(self, host = "127.0.0.1", port = 0):
+        # Serve from a thread with its own event loop so the server doesn't share the caller's loop.
+        self.loop = asyncio.new_event_loop()
+
+        ready = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+
+            self.loop.run_until_complete(self.start(host, port))
+
+            ready.set()
+
+            self.loop.run_forever()
+
+            self.loop.run_until_complete(self.stop())
+            self.loop.close()
+
+        self.thread = threading.Thread(target = run, daemon = True)
+        self.thread.start()
+
+        ready.wait()
+
+        return self.url
+
+    def stop_thread(self):
+        if self.thread is None:
+            return
+
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+        self.thread = None
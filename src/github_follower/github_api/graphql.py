@@ -0,0 +1,103 @@
+import json
+
+import misc
+
+from .pages import PER_PAGE, Page_Error
+from .decode import loads, to_ref
+
+# Max users looked up in one aliased query.
+LOOKUP_BATCH = 100
+
+USER_FIELDS = "databaseId login viewerIsFollowing isFollowingViewer"
+
+FOLLOWERS_FIELDS = "followers(first: $first, after: $after) { nodes { " + USER_FIELDS + " } pageInfo { hasNextPage endCursor } }"
+
+USER_FOLLOWERS_QUERY = "query($login: String!, $first: Int!, $after: String) { user(login: $login) { " + FOLLOWERS_FIELDS + " } }"
+VIEWER_FOLLOWERS_QUERY = "query($first: Int!, $after: String) { viewer { " + FOLLOWERS_FIELDS + " } }"
+
+def to_user(node):
+    # Use the same keys as the REST API plus the relationship fields.
+    return {"id": node.get("databaseId"), "login": node.get("login"), "viewerIsFollowing": node.get("viewerIsFollowing", False), "isFollowingViewer": node.get("isFollowingViewer", False)}
+
+async def send_query(api, query, variables = {}, slots = None, on_limited = None):
+    body = json.dumps({"query": query, "variables": variables})
+
+    while True:
+        if slots is not None:
+            async with slots:
+                res = await api.send("POST", "/graphql", {"Content-Type": "application/json"}, body)
+        else:
+            res = await api.send("POST", "/graphql", {"Content-Type": "application/json"}, body)
+
+        # Check status code.
+        if res[1] != 200:
+            if on_limited is not None and await on_limited(api, res):
+                continue
+
+            raise Page_Error("/graphql", res[1])
+
+        with misc.span("json.decode"):
+            ret = loads(res[0])
+
+        # GraphQL reports errors with a 200 status.
+        if ret.get("data") is None:
+            raise Page_Error("/graphql", str(res[1]) + " (" + json.dumps(ret.get("errors")) + ")")
+
+        return ret["data"]
+
+async def iter_followers(api, login = None, page = 1, after = None, last_page = 0, per_page = PER_PAGE, slots = None, on_limited = None):
+    # Yields (users, page, next page, next cursor) like iter_pages() with User_Refs and the GraphQL end cursor needed to resume. Leave login as None for the authenticated user's followers.
+    while page is not None:
+        if last_page > 0 and page > last_page:
+            return
+
+        variables = {"first": per_page, "after": after}
+
+        if login is None:
+            data = await send_query(api, VIEWER_FOLLOWERS_QUERY, variables, slots, on_limited)
+            followers = data["viewer"]["followers"]
+        else:
+            variables["login"] = login
+
+            data = await send_query(api, USER_FOLLOWERS_QUERY, variables, slots, on_limited)
+
+            if data.get("user") is None:
+                raise Page_Error("/graphql", "404")
+
+            followers = data["user"]["followers"]
+
+        users = [ref for ref in (to_ref(node, "databaseId") for node in followers["nodes"]) if ref is not None]
+
+        next_page = None
+
+        if followers["pageInfo"]["hasNextPage"]:
+            next_page = page + 1
+            after = followers["pageInfo"]["endCursor"]
+
+        yield users, page, next_page, after
+
+        page = next_page
+
+async def lookup_users(api, logins, slots = None, on_limited = None):
+    # Looks up many users with one aliased query per batch and returns a dictionary of login => user (None if the user doesn't exist).
+    ret = {}
+
+    logins = list(dict.fromkeys(logins))
+
+    for i in range(0, len(logins), LOOKUP_BATCH):
+        batch = logins[i:i + LOOKUP_BATCH]
+
+        fields = []
+
+        for j, login in enumerate(batch):
+            # JSON string literals are valid GraphQL string literals.
+            fields.append("u" + str(j) + ": user(login: " + json.dumps(login) + ") { " + USER_FIELDS + " }")
+
+        data = await send_query(api, "query { " + " ".join(fields) + " }", slots = slots, on_limited = on_limited)
+
+        for j, login in enumerate(batch):
+            node = data.get("u" + str(j))
+
+            ret[login] = to_user(node) if node is not None else None
+
+    return ret
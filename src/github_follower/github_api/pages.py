@@ -0,0 +1,78 @@
+import re
+
+from urllib.parse import urlsplit, parse_qs
+
+import misc
+
+from .decode import loads
+
+# Items per page. GitHub's default is 30 and the maximum is 100.
+PER_PAGE = 100
+
+LINK_NEXT = re.compile(r'<([^>]+)>\s*;\s*rel="next"')
+
+class Page_Error(Exception):
+    def __init__(self, url, status):
+        super().__init__("request to " + url + " failed with status " + str(status))
+
+        self.url = url
+        self.status = status
+
+def get_next_page(headers):
+    link = headers.get("Link")
+
+    if link is None:
+        return None
+
+    match = LINK_NEXT.search(link)
+
+    if match is None:
+        return None
+
+    try:
+        return int(parse_qs(urlsplit(match.group(1)).query)["page"][0])
+    except (KeyError, IndexError, ValueError):
+        return None
+
+async def iter_pages(api, url, page = 1, last_page = 0, per_page = PER_PAGE, slots = None, on_limited = None, decode = loads, cached_pages = None):
+    # Yields (data, page, next page) for each page starting at page. The next page is None on the last page and may be stored to resume later.
+    # If last_page is above 0, pages past it aren't requested.
+    # If given, slots is held while sending each request and on_limited(api, res) is awaited on failures and returns True if the request should be retried.
+    # Each page's body is decoded with decode (e.g. decode_users() for compact user records).
+    # If given, cached_pages(page) returns True for pages we request again later. Only their responses are cached and revalidated.
+    sep = "&" if "?" in url else "?"
+
+    while page is not None:
+        if last_page > 0 and page > last_page:
+            return
+
+        path = url + sep + "per_page=" + str(per_page) + "&page=" + str(page)
+
+        cache = cached_pages is not None and cached_pages(page)
+
+        if slots is not None:
+            async with slots:
+                res = await api.send("GET", path, cache = cache)
+        else:
+            res = await api.send("GET", path, cache = cache)
+
+        # Check status code.
+        if res[1] != 200 and res[1] != 204 and res[1] != 304:
+            if on_limited is not None and await on_limited(api, res):
+                continue
+
+            raise Page_Error(path, res[1])
+
+        # Decode JSON.
+        with misc.span("json.decode"):
+            data = decode(res[0]) if res[0] else []
+
+        next_page = get_next_page(res[2])
+
+        # Keep going on a full page if the response didn't carry a Link header.
+        if next_page is None and "Link" not in res[2] and len(data) >= per_page:
+            next_page = page + 1
+
+        yield data, page, next_page
+
+        page = next_page
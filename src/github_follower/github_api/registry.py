@@ -0,0 +1,49 @@
+from .api import GH_API
+
+class Client_Registry():
+    def __init__(self, clock = None):
+        self.clients = {}
+
+        # Clock handed to the clients for their rate limit budgets.
+        self.clock = clock
+
+    def get(self, key, user = None, token = None):
+        api = self.clients.get(key)
+
+        # Each key gets its own client with its own headers, fail counter and connection pool.
+        if api is None:
+            api = GH_API(self.clock)
+
+            self.clients[key] = api
+
+        # Refresh credentials in case they were changed in the admin center.
+        if user is not None and token is not None:
+            api.authenticate(user, token)
+
+        return api
+
+    def all(self):
+        return list(self.clients.values())
+
+    def set_clock(self, clock):
+        self.clock = clock
+
+        for api in self.clients.values():
+            api.clock = clock
+
+            for budget in api.budgets.values():
+                budget.clock = clock
+
+    def pending(self):
+        # Requests being sent by all clients.
+        return sum(api.pending for api in self.clients.values())
+
+    def reset_fails(self):
+        for api in self.clients.values():
+            api.fails = 0
+
+    async def close(self):
+        for api in self.clients.values():
+            await api.close()
+
+        self.clients = {}
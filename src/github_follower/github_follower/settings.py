@@ -126,4 +126,14 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # GitHub Follower Settings.
 MAX_USERS = 30
 SCAN_TIME = 15
-WAIT_TIME = 15
\ No newline at end of file
+WAIT_TIME = 15
+
+# GitHub API client settings.
+GH_API_ENDPOINT = 'https://api.github.com'
+GH_API_CONN_LIMIT = 10
+GH_API_DNS_TTL = 300
+GH_API_CONNECT_TIMEOUT = 10
+GH_API_READ_TIMEOUT = 30
+
+# Bearer token Prometheus sends to scrape /metrics (empty = staff sessions only on the web interface).
+METRICS_TOKEN = ''
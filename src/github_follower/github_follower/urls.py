@@ -16,6 +16,10 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path
 
+from gf import views
+
 urlpatterns = [
+    # Must come before the admin site which catches every other URL.
+    path('metrics', views.metrics, name = 'metrics'),
     path('', admin.site.urls),
 ]
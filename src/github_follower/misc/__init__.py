@@ -1,3 +1,6 @@
 __title__ = "Misc"
 __version__ = "1.0.0"
 
+from .metrics import *
+from .queries import *
+from .tracing import *
\ No newline at end of file
@@ -0,0 +1,184 @@
+import hmac
+import threading
+
+# Default histogram buckets in seconds.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def escape_label(val):
+    return str(val).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_labels(names, vals, extra = ""):
+    labels = [name + "=\"" + escape_label(val) + "\"" for name, val in zip(names, vals)]
+
+    if extra:
+        labels.append(extra)
+
+    if len(labels) < 1:
+        return ""
+
+    return "{" + ",".join(labels) + "}"
+
+def format_value(val):
+    if val == float("inf"):
+        return "+Inf"
+
+    if float(val).is_integer():
+        return str(int(val))
+
+    return repr(float(val))
+
+def check_token(auth, token):
+    # Scrapers send the METRICS_TOKEN setting as a bearer token. Without one set nothing is let through.
+    if not token:
+        return False
+
+    return hmac.compare_digest(auth.encode(), ("Bearer " + token).encode())
+
+class Metric():
+    kind = "untyped"
+
+    def __init__(self, name, help, labels = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+        # Values keyed by a tuple of label values. Metrics are updated from the parser and database threads.
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def get_key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def get(self, **labels):
+        return self.values.get(self.get_key(labels), 0)
+
+    def render(self):
+        lines = ["# HELP " + self.name + " " + self.help, "# TYPE " + self.name + " " + self.kind]
+
+        with self.lock:
+            for key, val in sorted(self.values.items()):
+                lines.append(self.name + format_labels(self.labels, key) + " " + format_value(val))
+
+        return lines
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount = 1, **labels):
+        key = self.get_key(labels)
+
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, val, **labels):
+        key = self.get_key(labels)
+
+        with self.lock:
+            self.values[key] = val
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels = (), buckets = BUCKETS):
+        super().__init__(name, help, labels)
+
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, val, **labels):
+        key = self.get_key(labels)
+
+        with self.lock:
+            # Bucket counts (not cumulative), sum and count.
+            item = self.values.get(key)
+
+            if item is None:
+                item = [[0] * len(self.buckets), 0.0, 0]
+
+                self.values[key] = item
+
+            for i, bound in enumerate(self.buckets):
+                if val <= bound:
+                    item[0][i] = item[0][i] + 1
+
+                    break
+
+            item[1] = item[1] + val
+            item[2] = item[2] + 1
+
+    def get(self, **labels):
+        item = self.values.get(self.get_key(labels))
+
+        if item is None:
+            return 0
+
+        return item[2]
+
+    def render(self):
+        lines = ["# HELP " + self.name + " " + self.help, "# TYPE " + self.name + " " + self.kind]
+
+        with self.lock:
+            for key, item in sorted(self.values.items()):
+                total = 0
+
+                for bound, cnt in zip(self.buckets, item[0]):
+                    total = total + cnt
+
+                    lines.append(self.name + "_bucket" + format_labels(self.labels, key, "le=\"" + format_value(bound) + "\"") + " " + str(total))
+
+                lines.append(self.name + "_sum" + format_labels(self.labels, key) + " " + format_value(item[1]))
+                lines.append(self.name + "_count" + format_labels(self.labels, key) + " " + str(item[2]))
+
+        return lines
+
+class Metrics_Registry():
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+
+        return metric
+
+    def counter(self, name, help, labels = ()):
+        return self.add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels = ()):
+        return self.add(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels = (), buckets = BUCKETS):
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        # Prometheus text exposition format.
+        lines = []
+
+        for metric in self.metrics:
+            lines.extend(metric.render())
+
+        return "\n".join(lines) + "\n"
+
+stats = Metrics_Registry()
+
+# GitHub API.
+api_latency = stats.histogram("gf_api_request_seconds", "GitHub API request latency.", ("method", "endpoint", "status"))
+api_requests = stats.counter("gf_api_requests_total", "GitHub API requests sent by credential.", ("credential",))
+api_remaining = stats.gauge("gf_api_rate_limit_remaining", "Requests left in the credential's rate limit window of each resource.", ("credential", "resource"))
+
+# Database.
+db_queries = stats.counter("gf_db_queries_total", "DB queries ran by parser loop.", ("loop",))
+db_time = stats.counter("gf_db_query_seconds_total", "Seconds spent in DB queries by parser loop.", ("loop",))
+
+# Parser.
+users_parsed = stats.counter("gf_users_parsed_total", "Users parsed.")
+users_seeded = stats.counter("gf_users_seeded_total", "Users added through seeding.")
+users_followed = stats.counter("gf_users_followed_total", "Users followed by target user ID.", ("target_user",))
+users_unfollowed = stats.counter("gf_users_unfollowed_total", "Users unfollowed by target user ID.", ("target_user",))
+parse_queue = stats.gauge("gf_parse_queue_users", "Users waiting to be parsed (never_parsed is the part that hasn't been parsed yet).", ("state",))
+job_queue = stats.gauge("gf_jobs", "Jobs by kind and status.", ("kind", "status"))
+task_restarts = stats.counter("gf_task_restarts_total", "Restarts of the parser's supervised tasks.", ("task",))
+parser_shard = stats.gauge("gf_parser_shard", "Index of the user shard this process parses.")
+parser_shards = stats.gauge("gf_parser_shards", "Number of shards users are split into.")
+parser_leader = stats.gauge("gf_parser_leader", "1 if this process runs the target user loops.")
@@ -0,0 +1,46 @@
+import contextvars
+import threading
+import time
+
+from django.db.backends.signals import connection_created
+
+from .metrics import db_queries, db_time
+
+# Name of the parser loop the current task belongs to. Context variables are carried through sync_to_async() so queries are attributed to the loop that awaited them.
+cur_loop = contextvars.ContextVar("cur_loop", default = None)
+
+class Query_Counter():
+    def __init__(self):
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        loop = cur_loop.get()
+
+        if loop is None:
+            return execute(sql, params, many, context)
+
+        with self.lock:
+            self.counts[loop] = self.counts.get(loop, 0) + 1
+
+        start = time.perf_counter()
+
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            db_queries.inc(loop = loop)
+            db_time.inc(time.perf_counter() - start, loop = loop)
+
+    def install(self, connection):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def get_count(self, loop):
+        return self.counts.get(loop, 0)
+
+counter = Query_Counter()
+
+def install_counter(sender, connection, **kwargs):
+    counter.install(connection)
+
+connection_created.connect(install_counter)
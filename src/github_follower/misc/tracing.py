@@ -0,0 +1,150 @@
+import asyncio
+import contextvars
+import functools
+import threading
+import time
+
+# Names of the spans the current task is in. Context variables are carried through sync_to_async() so spans in database threads nest under the span that awaited them.
+cur_stack = contextvars.ContextVar("cur_stack", default = ())
+
+class Null_Span():
+    # Returned while tracing is disabled so a span costs one function call.
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+NULL_SPAN = Null_Span()
+
+class Span():
+    __slots__ = ("tracer", "name", "start", "token")
+
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.token = cur_stack.set(cur_stack.get() + (self.name,))
+        self.start = time.perf_counter()
+
+        return self
+
+    def __exit__(self, *args):
+        elapsed = time.perf_counter() - self.start
+
+        stack = cur_stack.get()
+
+        cur_stack.reset(self.token)
+
+        self.tracer.record(stack, elapsed)
+
+        return False
+
+class Tracer():
+    def __init__(self):
+        self.enabled = False
+
+        # Call count and total seconds keyed by span stack.
+        self.totals = {}
+        self.lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self.lock:
+            self.totals = {}
+
+    def span(self, name):
+        if not self.enabled:
+            return NULL_SPAN
+
+        return Span(self, name)
+
+    def set_root(self, name):
+        # Spans of the current task nest under name (e.g. the parser loop) without timing it.
+        if self.enabled:
+            cur_stack.set((name,))
+
+    def record(self, stack, elapsed):
+        with self.lock:
+            item = self.totals.get(stack)
+
+            if item is None:
+                item = [0, 0.0]
+
+                self.totals[stack] = item
+
+            item[0] = item[0] + 1
+            item[1] = item[1] + elapsed
+
+    def get_self_times(self):
+        # Time spent in each span stack excluding its child spans. Awaits count toward the span that was suspended.
+        with self.lock:
+            totals = {stack: list(item) for stack, item in self.totals.items()}
+
+        self_times = {stack: item[1] for stack, item in totals.items()}
+
+        for stack, item in totals.items():
+            parent = stack[:-1]
+
+            if parent in self_times:
+                self_times[parent] = self_times[parent] - item[1]
+
+        return totals, self_times
+
+    def folded(self):
+        # Folded stacks with microseconds of self time for flame graph tools.
+        totals, self_times = self.get_self_times()
+
+        lines = []
+
+        for stack in sorted(totals.keys()):
+            lines.append(";".join(stack) + " " + str(max(int(self_times[stack] * 1000000), 0)))
+
+        return "\n".join(lines) + "\n"
+
+    def summary(self, top = 0):
+        totals, self_times = self.get_self_times()
+
+        stacks = sorted(totals.keys(), key = lambda stack: self_times[stack], reverse = True)
+
+        if top > 0:
+            stacks = stacks[:top]
+
+        lines = [format("Span", "<60") + format("Calls", ">10") + format("Total (s)", ">12") + format("Self (s)", ">12") + format("Avg (ms)", ">12")]
+
+        for stack in stacks:
+            cnt, total = totals[stack]
+
+            lines.append(format(";".join(stack)[-60:], "<60") + format(cnt, ">10") + format(total, ">12.3f") + format(self_times[stack], ">12.3f") + format(total / cnt * 1000, ">12.3f"))
+
+        return "\n".join(lines)
+
+tracer = Tracer()
+
+def span(name):
+    return tracer.span(name)
+
+def traced(name):
+    # Decorator that wraps a function or coroutine function in a span.
+    def decorator(func):
+        # asyncio's check also recognizes functions wrapped by sync_to_async().
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with tracer.span(name):
+                    return await func(*args, **kwargs)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with tracer.span(name):
+                    return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator